@@ -0,0 +1,98 @@
+import functools
+import json
+import os
+from itertools import combinations
+
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def dhash(image, hash_size=8):
+    """Difference hash of an already decoded Pillow image, as a 64-bit integer"""
+    from PIL import Image
+
+    # Every bit tells whether a grey pixel is brighter than its right neighbour, so re-encodes,
+    # resizes and format changes of the same picture end up a few bits apart at most
+    small = image.resize((hash_size + 1, hash_size), Image.Resampling.BOX).convert('L')
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+@functools.lru_cache(maxsize=None)
+def _flip_masks(radius):
+    """XOR masks turning a chunk into all chunks within the given Hamming radius of it"""
+    masks = [0]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            masks.append(sum(1 << bit for bit in bits))
+    return masks
+
+
+# Every hash is split into 4 chunks of 16 bits with one lookup table per chunk. Two hashes within
+# distance d agree on at least one chunk up to d // 4 bits (pigeonhole), so a query only probes
+# the neighbouring values of its own chunks: at most 68 lookups for d < 8, however large the index
+class MultiIndexHash:
+    """Index of 64-bit hashes for Hamming-distance queries (multi-index hashing)"""
+
+    def __init__(self):
+        self.entries = []
+        self.tables = [{} for _ in range(CHUNKS)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, hash_value, payload):
+        entry_id = len(self.entries)
+        self.entries.append((hash_value, payload))
+        for chunk, table in enumerate(self.tables):
+            table.setdefault((hash_value >> (chunk * CHUNK_BITS)) & CHUNK_MASK, []).append(entry_id)
+
+    def find(self, hash_value, max_distance):
+        """Return (distance, hash, payload) of all entries within max_distance, closest first"""
+        masks = _flip_masks(max_distance // CHUNKS)
+        entries = self.entries
+        found = set()
+        for chunk, table in enumerate(self.tables):
+            value = (hash_value >> (chunk * CHUNK_BITS)) & CHUNK_MASK
+            for mask in masks:
+                for entry_id in table.get(value ^ mask, ()):
+                    if (hash_value ^ entries[entry_id][0]).bit_count() <= max_distance:
+                        found.add(entry_id)
+        matches = []
+        for entry_id in found:
+            stored_hash, payload = entries[entry_id]
+            matches.append((hamming(hash_value, stored_hash), stored_hash, payload))
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+def load_index(path):
+    """Load an index saved with save_index; a missing file gives an empty index"""
+    index = MultiIndexHash()
+    try:
+        with open(path, encoding='utf8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return index
+    for hash_hex, payload in data['entries']:
+        index.add(int(hash_hex, 16), payload)
+    return index
+
+
+def save_index(index, path):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf8') as f:
+        json.dump({'entries': [[format(hash_value, '016x'), payload] for hash_value, payload in index.entries]}, f)
+    os.replace(temp_path, path)
@@ -0,0 +1,221 @@
+import argparse
+import json
+import math
+import sqlite3
+from pathlib import Path
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    export TEXT NOT NULL,
+    key TEXT NOT NULL,
+    taken_at TEXT NOT NULL,
+    latitude REAL,
+    longitude REAL,
+    caption TEXT,
+    UNIQUE (export, key)
+);
+CREATE INDEX IF NOT EXISTS posts_taken_at ON posts (taken_at);
+
+CREATE TABLE IF NOT EXISTS files (
+    post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    input_path TEXT,
+    output_path TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_post_id ON files (post_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_location USING rtree (id, min_latitude, max_latitude, min_longitude, max_longitude);
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_caption USING fts5 (caption);
+"""
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LATITUDE = 111.32
+
+
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance between two points in km (haversine)"""
+    if None in (latitude1, longitude1, latitude2, longitude2):
+        return None
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    delta_phi = phi2 - phi1
+    delta_lambda = math.radians(longitude2 - longitude1)
+    a = math.sin(delta_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def connect(db_path):
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.create_function("distance_km", 4, distance_km, deterministic=True)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _taken_at(value):
+    """Normalize posts.json takenAt (2023-01-10T12:00:00.000Z) to a sortable 2023-01-10T12:00:00"""
+    return value[:19]
+
+
+def add_manifest(connection, manifest, output_root):
+    """Add (or replace) the posts of a run manifest in the catalog; returns the number of posts"""
+    # Absolute, so the paths work and the export is the same row whatever the working directory
+    output_root = Path(output_root).resolve()
+    export = str(Path(manifest['export']).resolve())
+    with connection:
+        for record in manifest['posts']:
+            # Replace what an earlier run of the same export stored for this post
+            row = connection.execute("SELECT id FROM posts WHERE export = ? AND key = ?", (export, record['key'])).fetchone()
+            if row:
+                connection.execute("DELETE FROM posts_location WHERE id = ?", row)
+                connection.execute("DELETE FROM posts_caption WHERE rowid = ?", row)
+                connection.execute("DELETE FROM posts WHERE id = ?", row)
+
+            location = record.get('location') or {}
+            latitude = location.get('latitude')
+            longitude = location.get('longitude')
+            caption = record.get('caption')
+            post_id = connection.execute(
+                "INSERT INTO posts (export, key, taken_at, latitude, longitude, caption) VALUES (?, ?, ?, ?, ?, ?)",
+                (export, record['key'], _taken_at(record['takenAt']), latitude, longitude, caption),
+            ).lastrowid
+
+            if latitude is not None and longitude is not None:
+                connection.execute("INSERT INTO posts_location VALUES (?, ?, ?, ?, ?)",
+                                   (post_id, latitude, latitude, longitude, longitude))
+            if caption:
+                connection.execute("INSERT INTO posts_caption (rowid, caption) VALUES (?, ?)", (post_id, caption))
+
+            inputs = record.get('inputs', {})
+            output_info = record.get('output_info', {})
+            for role, output_path in record['outputs'].items():
+                info = output_info.get(role, {})
+                # Outputs written to an archive are stored as archive#member
+                if record.get('archive'):
+                    output_path = f"{output_root / record['archive']}#{output_path}"
+                else:
+                    output_path = str(output_root / output_path)
+                connection.execute(
+                    "INSERT INTO files (post_id, role, input_path, output_path, width, height, bytes) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (post_id, role, inputs.get(role), output_path,
+                     info.get('width'), info.get('height'), info.get('bytes')),
+                )
+    return len(manifest['posts'])
+
+
+def query_posts(connection, date_from=None, date_to=None, near=None, radius_km=None, text=None, limit=None):
+    """Return the posts matching all given filters, oldest first (closest first for --near)"""
+    # The time range uses the B-tree index on taken_at, --near the R-tree before the exact distance, --text FTS5
+    conditions = []
+    parameters = []
+    distance = "NULL"
+
+    if date_from:
+        conditions.append("posts.taken_at >= ?")
+        parameters.append(date_from)
+    if date_to:
+        # A bare date includes the whole day
+        conditions.append("posts.taken_at <= ?")
+        parameters.append(date_to + "T23:59:59" if len(date_to) == 10 else date_to)
+    if near:
+        latitude, longitude = near
+        radius_km = radius_km or 1.0
+        delta_latitude = radius_km / KM_PER_DEGREE_LATITUDE
+        delta_longitude = radius_km / (KM_PER_DEGREE_LATITUDE * max(math.cos(math.radians(latitude)), 1e-6))
+        conditions.append("posts.id IN (SELECT id FROM posts_location WHERE min_latitude <= ? AND max_latitude >= ? "
+                          "AND min_longitude <= ? AND max_longitude >= ?)")
+        parameters += [latitude + delta_latitude, latitude - delta_latitude,
+                       longitude + delta_longitude, longitude - delta_longitude]
+        distance = "distance_km(posts.latitude, posts.longitude, ?, ?)"
+        conditions.append(f"{distance} <= ?")
+        parameters += [latitude, longitude, radius_km]
+    if text:
+        conditions.append("posts.id IN (SELECT rowid FROM posts_caption WHERE posts_caption MATCH ?)")
+        parameters.append(text)
+
+    sql = "SELECT posts.id, export, taken_at, latitude, longitude, caption"
+    if near:
+        sql += f", {distance} AS distance"
+        parameters = [near[0], near[1]] + parameters
+    sql += " FROM posts"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY distance, taken_at" if near else " ORDER BY taken_at"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+
+    posts = []
+    for row in connection.execute(sql, parameters):
+        post = {
+            'export': row[1],
+            'taken_at': row[2],
+            'latitude': row[3],
+            'longitude': row[4],
+            'caption': row[5],
+        }
+        if near:
+            post['distance_km'] = round(row[6], 3)
+        post['files'] = [
+            {'role': role, 'input_path': input_path, 'output_path': output_path, 'width': width, 'height': height, 'bytes': size}
+            for role, input_path, output_path, width, height, size in connection.execute(
+                "SELECT role, input_path, output_path, width, height, bytes FROM files WHERE post_id = ?", (row[0],))
+        ]
+        posts.append(post)
+    return posts
+
+
+def parse_point(value):
+    try:
+        latitude, longitude = (float(part) for part in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected LAT,LON, got '{value}'")
+    return latitude, longitude
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the catalog of processed BeReal posts.')
+    parser.add_argument("catalog", type=str, help="Path to catalog.sqlite")
+    parser.add_argument("--from", dest="date_from", type=str, help="Earliest capture time, e.g. 2023-01-01")
+    parser.add_argument("--to", dest="date_to", type=str, help="Latest capture time, e.g. 2023-12-31")
+    parser.add_argument("--near", type=parse_point, metavar="LAT,LON", help="Only posts close to this location")
+    parser.add_argument("--radius-km", type=float, default=1.0, help="Radius for --near in km (default: 1)")
+    parser.add_argument("--text", type=str, help="Full-text search in captions (FTS5 syntax)")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--json", action="store_true", help="Print the matches as JSON")
+    parser.add_argument("--add-manifest", type=str, metavar="MANIFEST",
+                        help="Add the posts of a run manifest (e.g. a merged shard manifest) to the catalog and exit")
+    args = parser.parse_args()
+
+    connection = connect(args.catalog)
+
+    if args.add_manifest:
+        with open(args.add_manifest, encoding="utf8") as f:
+            manifest = json.load(f)
+        count = add_manifest(connection, manifest, Path(args.add_manifest).parent)
+        print(f"Added {count} posts to {args.catalog}")
+        return
+
+    posts = query_posts(connection, args.date_from, args.date_to, args.near, args.radius_km, args.text, args.limit)
+    if args.json:
+        print(json.dumps(posts, indent=2, ensure_ascii=False))
+        return
+
+    for post in posts:
+        line = post['taken_at']
+        if 'distance_km' in post:
+            line += f"  {post['distance_km']:.2f} km"
+        if post['caption']:
+            line += f"  \"{post['caption']}\""
+        print(line)
+        for file in post['files']:
+            size = f"{file['width']}x{file['height']}" if file['width'] else ""
+            print(f"    {file['role']}: {file['output_path']} {size}")
+    print(f"{len(posts)} posts found")
+
+
+if __name__ == "__main__":
+    main()
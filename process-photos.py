@@ -1,17 +1,34 @@
 import json
+import multiprocessing
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageOps, ExifTags
 import logging
 from pathlib import Path
-import piexif
 import os
 import time
 import shutil
-from iptcinfo3 import IPTCInfo
+import signal
 import argparse
+import contextlib
+import errno
+import functools
+import hashlib
+import io
+import math
+import select
+import socket
+import socketserver
 import subprocess
+import tarfile
 import tempfile
-import ffmpeg
+import threading
+import warnings
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# Pillow, piexif, iptcinfo3 and ffmpeg-python are imported inside the functions that
+# need them, so that --plan can print the work plan without loading any of them.
 
 # ANSI escape codes for text styling
 STYLING = {
@@ -41,39 +58,105 @@ handler = logger.handlers[0]  # Get the default handler installed by basicConfig
 handler.setFormatter(ColorFormatter('%(asctime)s - %(levelname)s - %(message)s'))
 
 # Initialize counters
-processed_files_count = 0
-converted_files_count = 0
-combined_files_count = 0
-skipped_files_count = 0
-video_files_count = 0
+def new_counters():
+    return {
+        'processed': 0,
+        'converted': 0,
+        'combined': 0,
+        'skipped': 0,
+        'videos': 0,
+        'duplicates': 0,
+        'renditions': 0,
+        'quarantined': 0,
+    }
 
 # Static IPTC tags
 source_app = "BeReal app"
 processing_tool = "github/bereal-gdpr-photo-toolkit"
 
-# Define lists to hold the combination data
-primary_images = []
+# Default settings
+DEFAULT_SETTINGS = {
+    'convert_format': 'no',
+    'target_format': 'jpg',
+    'keep_original_filename': 'no',
+    'create_combined_images': 'yes',
+    'process_videos': 'yes',
+    'image_quality': 95,  # High quality for images (1-100, higher = better)
+    'video_crf': 18,      # High quality for videos (0-51, lower = better)
+    'dedupe': 'no',           # 'near' to detect posts that are near-duplicates of earlier ones
+    'dedupe_action': 'skip',  # 'skip' near-duplicates, or 'link' their outputs to the earlier post's
+    'dedupe_distance': 6,     # Maximum Hamming distance (0-16) between perceptual hashes
+    'renditions': [],         # Extra sizes of every image, e.g. {"name": "web", "max_size": 2048, "format": "jpg", "quality": 85}
+    'encoder_profile': 'default',  # Name from ENCODER_PROFILES, or a dict with the options to change from 'default'
+    'target_kb': 0,           # Largest size of encoded images in KB, lowering their quality as needed (0 = off)
+    'encoder_report': 'no',   # 'yes' to also encode every image with the default encoder and report the difference
+    'post_timeout': 600,      # Seconds one post may take before it is stopped and its inputs quarantined (0 = no limit)
+    'ffmpeg_timeout': 300,    # Seconds one ffmpeg or ffprobe call may take before it is killed (0 = no limit)
+    'max_megapixels': 50,     # Larger images are refused as decompression bombs (0 = Pillow's own limit)
+    'text_overlay': 'no',     # Burn 'date', 'caption' or 'both' into the combined images
+    'overlay_font': '',       # TrueType font for the text overlay (empty = Pillow's built-in font)
+}
+
+# Encoder profiles for images and videos. 'default' is how the script always encoded.
+ENCODER_PROFILES = {
+    'default': {
+        'jpeg_progressive': 'no',
+        'jpeg_optimize': 'no',         # Optimized Huffman tables
+        'jpeg_subsampling': 'default',  # Chroma subsampling: 'default' (Pillow's), '4:4:4', '4:2:2' or '4:2:0'
+        'webp_method': 4,              # 0 (fast) to 6 (smallest)
+        'video_preset': 'medium',
+        'video_tune': 'none',
+        'video_threads': 0,            # Threads of one video encode, 0 lets x264 decide
+    },
+    'compact': {
+        'jpeg_progressive': 'yes',
+        'jpeg_optimize': 'yes',
+        'jpeg_subsampling': '4:2:0',
+        'webp_method': 6,
+        'video_preset': 'slow',
+        'video_tune': 'none',
+        'video_threads': 0,
+    },
+    'fidelity': {
+        'jpeg_progressive': 'yes',
+        'jpeg_optimize': 'yes',
+        'jpeg_subsampling': '4:4:4',
+        'webp_method': 6,
+        'video_preset': 'slow',
+        'video_tune': 'film',
+        'video_threads': 0,
+    },
+    'fast': {
+        'jpeg_progressive': 'no',
+        'jpeg_optimize': 'no',
+        'jpeg_subsampling': '4:2:0',
+        'webp_method': 1,
+        'video_preset': 'veryfast',
+        'video_tune': 'none',
+        'video_threads': 0,
+    },
+}
+VIDEO_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow']
+TEXT_OVERLAYS = ['no', 'date', 'caption', 'both']
+VIDEO_TUNES = ['none', 'film', 'animation', 'grain', 'stillimage', 'fastdecode', 'zerolatency']
+TARGET_MIN_QUALITY = 40  # The target size never pushes image quality below this
 
 # Define paths using pathlib
-parser = argparse.ArgumentParser(description='Process BeReal photos and videos.')
-parser.add_argument('--path', type=str, help='Path to the BeReal data export folder')
-args = parser.parse_args()
-
-json_path = Path(args.path + '/posts.json')
-photo_folder = Path(args.path + '/Photos/post/')
-bereal_folder = Path(args.path + '/Photos/bereal')
-output_folder = Path(args.path + '/Photos/post/__processed')
-output_folder_combined = Path(args.path + '/Photos/post/__combined')
-output_folder.mkdir(parents=True, exist_ok=True)  # Create the output folder if it doesn't exist
-
-# Print the paths
-print(STYLING["BOLD"] + "\nThe following paths are set for the input and output files:" + STYLING["RESET"])
-print(f"Photo folder: {photo_folder}")
-if os.path.exists(bereal_folder):
-    print(f"Older photo folder: {bereal_folder}")
-print(f"Output folder for singular images: {output_folder}")
-print(f"Output folder for combined images: {output_folder_combined}")
-print("")
+def get_export_paths(export_path, output_root=None):
+    """Return the input and output folders of a BeReal data export; outputs go next to the photos unless output_root is given"""
+    export_path = Path(export_path)
+    output_root = Path(output_root) if output_root else export_path / 'Photos' / 'post'
+    return {
+        'export': str(export_path.resolve()),  # Identifies the export in manifests and the perceptual-hash index
+        'json_path': export_path / 'posts.json',
+        'output_root': output_root,
+        'files_root': output_root,  # The output folders are in here, for the manifest paths
+        'photo_folder': export_path / 'Photos' / 'post',
+        'bereal_folder': export_path / 'Photos' / 'bereal',
+        'output_folder': output_root / '__processed',
+        'output_folder_combined': output_root / '__combined',
+        'phash_index': output_root / 'phash-index.json',
+    }
 
 # Function to count number of input files - updated to handle both .webp and .jpg
 def count_files_in_folder(folder_path):
@@ -84,38 +167,25 @@ def count_files_in_folder(folder_path):
     mov_count = len(list(folder.glob('*.mov')))
     return webp_count + jpg_count + mp4_count + mov_count
 
-number_of_files = count_files_in_folder(photo_folder)
-print(f"Number of image files in {photo_folder}: {number_of_files}")
-
-if os.path.exists(bereal_folder):
-    number_of_files = count_files_in_folder(bereal_folder)
-    print(f"Number of (older) image files in {bereal_folder}: {number_of_files}")
-
 # Settings
-## Initial choice for accessing advanced settings
-print(STYLING["BOLD"] + "\nDo you want to access advanced settings or run with default settings?" + STYLING["RESET"])
-print("Default settings are:\n"
-"1. Images remain in their original format (WebP remains WebP, JPG remains JPG)\n"
-"2. Converted images' filenames do not contain the original filename\n"
-"3. Combined images are created on top of processed singular images\n"
-"4. Videos are processed and combined with image overlays\n"
-"5. High quality settings (Image: 95/100, Video CRF: 18/51)")
-advanced_settings = input("\nEnter " + STYLING["BOLD"] + "'yes'" + STYLING["RESET"] + "for advanced settings or press any key to continue with default settings: ").strip().lower()
-
-if advanced_settings != 'yes':
-    print("Continuing with default settings.\n")
-
-## Default responses - updated to maintain original format as default
-convert_format = 'no'
-target_format = 'jpg'
-keep_original_filename = 'no'
-create_combined_images = 'yes'
-process_videos = 'yes'
-image_quality = 95  # High quality for images (1-100, higher = better)
-video_crf = 18     # High quality for videos (0-51, lower = better)
-
-## Proceed with advanced settings if chosen
-if advanced_settings == 'yes':
+def prompt_settings():
+    """Ask the user for the settings of this run, starting from the defaults"""
+    settings = dict(DEFAULT_SETTINGS)
+
+    ## Initial choice for accessing advanced settings
+    print(STYLING["BOLD"] + "\nDo you want to access advanced settings or run with default settings?" + STYLING["RESET"])
+    print("Default settings are:\n"
+    "1. Images remain in their original format (WebP remains WebP, JPG remains JPG)\n"
+    "2. Converted images' filenames do not contain the original filename\n"
+    "3. Combined images are created on top of processed singular images\n"
+    "4. Videos are processed and combined with image overlays\n"
+    "5. High quality settings (Image: 95/100, Video CRF: 18/51)")
+    advanced_settings = input("\nEnter " + STYLING["BOLD"] + "'yes'" + STYLING["RESET"] + "for advanced settings or press any key to continue with default settings: ").strip().lower()
+
+    if advanced_settings != 'yes':
+        print("Continuing with default settings.\n")
+        return settings
+
     # User choice for converting format
     convert_format = None
     while convert_format not in ['yes', 'no']:
@@ -124,10 +194,12 @@ if advanced_settings == 'yes':
             target_format = None
             while target_format not in ['jpg', 'webp']:
                 target_format = input(STYLING["BOLD"] + "   Which format do you want to convert to? (jpg/webp): " + STYLING["RESET"]).strip().lower()
+            settings['target_format'] = target_format
         if convert_format == 'no':
             print("Your images will remain in their original format. Metadata will still be added.")
         if convert_format not in ['yes', 'no']:
             logging.error("Invalid input. Please enter 'yes' or 'no'.")
+    settings['convert_format'] = convert_format
 
     # User choice for keeping original filename
     print(STYLING["BOLD"] + "\n2. There are two options for how output files can be named" + STYLING["RESET"] + "\n"
@@ -139,6 +211,7 @@ if advanced_settings == 'yes':
         keep_original_filename = input(STYLING["BOLD"] + "Do you want to keep the original filename in the renamed file? (yes/no): " + STYLING["RESET"]).strip().lower()
         if keep_original_filename not in ['yes', 'no']:
             logging.error("Invalid input. Please enter 'yes' or 'no'.")
+    settings['keep_original_filename'] = keep_original_filename
 
     # User choice for creating combined images
     create_combined_images = None
@@ -146,6 +219,7 @@ if advanced_settings == 'yes':
         create_combined_images = input(STYLING["BOLD"] + "\n3. Do you want to create combined images like the original BeReal memories? (yes/no): " + STYLING["RESET"]).strip().lower()
         if create_combined_images not in ['yes', 'no']:
             logging.error("Invalid input. Please enter 'yes' or 'no'.")
+    settings['create_combined_images'] = create_combined_images
 
     # User choice for processing videos
     process_videos = None
@@ -153,11 +227,12 @@ if advanced_settings == 'yes':
         process_videos = input(STYLING["BOLD"] + "\n4. Do you want to process and combine videos with image overlays? (yes/no): " + STYLING["RESET"]).strip().lower()
         if process_videos not in ['yes', 'no']:
             logging.error("Invalid input. Please enter 'yes' or 'no'.")
+    settings['process_videos'] = process_videos
 
     # User choice for quality settings
     print(STYLING["BOLD"] + "\n5. Quality Settings" + STYLING["RESET"])
     print("Current defaults: Image quality=95 (1-100, higher=better), Video CRF=18 (0-51, lower=better)")
-    
+
     quality_choice = input(STYLING["BOLD"] + "Do you want to customize quality settings? (yes/no): " + STYLING["RESET"]).strip().lower()
     if quality_choice == 'yes':
         # Image quality setting
@@ -168,13 +243,14 @@ if advanced_settings == 'yes':
                     break  # Keep default
                 image_quality = int(image_quality_input)
                 if 1 <= image_quality <= 100:
+                    settings['image_quality'] = image_quality
                     break
                 else:
                     print("Please enter a number between 1 and 100.")
             except ValueError:
                 print("Please enter a valid number.")
-        
-        # Video quality setting  
+
+        # Video quality setting
         while True:
             try:
                 video_crf_input = input(STYLING["BOLD"] + "Video CRF (0-51, recommend 15-23, default 18): " + STYLING["RESET"]).strip()
@@ -182,54 +258,232 @@ if advanced_settings == 'yes':
                     break  # Keep default
                 video_crf = int(video_crf_input)
                 if 0 <= video_crf <= 51:
+                    settings['video_crf'] = video_crf
                     break
                 else:
                     print("Please enter a number between 0 and 51.")
             except ValueError:
                 print("Please enter a valid number.")
-    
-    print(f"Using image quality: {image_quality}, video CRF: {video_crf}")
 
-if convert_format == 'no' and create_combined_images == 'no':
-    print("You chose not to convert image formats nor do you want to output combined images.\n"
-    "The script will therefore only copy images to a new folder and rename them according to your choice, adding metadata.\n"
-    "Script will continue to run in 5 seconds.")
-    time.sleep(5)
+    print(f"Using image quality: {settings['image_quality']}, video CRF: {settings['video_crf']}")
+
+    if settings['convert_format'] == 'no' and settings['create_combined_images'] == 'no':
+        print("You chose not to convert image formats nor do you want to output combined images.\n"
+        "The script will therefore only copy images to a new folder and rename them according to your choice, adding metadata.\n"
+        "Script will continue to run in 5 seconds.")
+        time.sleep(5)
+
+    return settings
+
+# Function to load the settings from a JSON file instead of asking for them
+def load_settings(settings_path):
+    """Read a JSON settings file; missing keys keep their default value"""
+    with open(settings_path, encoding="utf8") as f:
+        return validate_settings(json.load(f))
+
+def validate_settings(loaded):
+    """Return the defaults updated with the given settings; raises ValueError for invalid ones"""
+    unknown = set(loaded) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(loaded)
+
+    for key in ['convert_format', 'keep_original_filename', 'create_combined_images', 'process_videos']:
+        if settings[key] not in ['yes', 'no']:
+            raise ValueError(f"Setting '{key}' must be 'yes' or 'no'")
+    if settings['target_format'] not in ['jpg', 'webp']:
+        raise ValueError("Setting 'target_format' must be 'jpg' or 'webp'")
+    if not 1 <= int(settings['image_quality']) <= 100:
+        raise ValueError("Setting 'image_quality' must be between 1 and 100")
+    if not 0 <= int(settings['video_crf']) <= 51:
+        raise ValueError("Setting 'video_crf' must be between 0 and 51")
+    if settings['dedupe'] not in ['no', 'near']:
+        raise ValueError("Setting 'dedupe' must be 'no' or 'near'")
+    if settings['dedupe_action'] not in ['skip', 'link']:
+        raise ValueError("Setting 'dedupe_action' must be 'skip' or 'link'")
+    if not 0 <= int(settings['dedupe_distance']) <= 16:
+        raise ValueError("Setting 'dedupe_distance' must be between 0 and 16")
+    settings['renditions'] = validate_renditions(settings['renditions'], settings['image_quality'])
+    get_encoder(settings)
+    if int(settings['target_kb']) < 0:
+        raise ValueError("Setting 'target_kb' must be 0 (off) or a size in KB")
+    if settings['encoder_report'] not in ['yes', 'no']:
+        raise ValueError("Setting 'encoder_report' must be 'yes' or 'no'")
+    for key in ['post_timeout', 'ffmpeg_timeout', 'max_megapixels']:
+        if float(settings[key]) < 0:
+            raise ValueError(f"Setting '{key}' must be 0 (no limit) or more")
+    if settings['text_overlay'] not in TEXT_OVERLAYS:
+        raise ValueError(f"Setting 'text_overlay' must be one of {', '.join(TEXT_OVERLAYS)}")
+    if settings['overlay_font'] and not Path(settings['overlay_font']).is_file():
+        raise ValueError(f"Overlay font {settings['overlay_font']} not found")
+    return settings
+
+def get_encoder(settings):
+    """Return the encoder options of the settings' profile; raises ValueError for invalid ones"""
+    profile = settings['encoder_profile']
+    if isinstance(profile, dict):
+        unknown = set(profile) - set(ENCODER_PROFILES['default'])
+        if unknown:
+            raise ValueError(f"Unknown encoder options: {', '.join(sorted(unknown))}")
+        encoder = {**ENCODER_PROFILES['default'], **profile}
+    elif profile in ENCODER_PROFILES:
+        encoder = dict(ENCODER_PROFILES[profile])
+    else:
+        raise ValueError(f"Setting 'encoder_profile' must be one of {', '.join(ENCODER_PROFILES)} or a dict of encoder options")
+    encoder.update(settings.get('video_encoding', {}))  # Chosen by the video calibration
+
+    for key in ['jpeg_progressive', 'jpeg_optimize']:
+        if encoder[key] not in ['yes', 'no']:
+            raise ValueError(f"Encoder option '{key}' must be 'yes' or 'no'")
+    if encoder['jpeg_subsampling'] not in ['default', '4:4:4', '4:2:2', '4:2:0']:
+        raise ValueError("Encoder option 'jpeg_subsampling' must be 'default', '4:4:4', '4:2:2' or '4:2:0'")
+    if not 0 <= int(encoder['webp_method']) <= 6:
+        raise ValueError("Encoder option 'webp_method' must be between 0 and 6")
+    if encoder['video_preset'] not in VIDEO_PRESETS:
+        raise ValueError(f"Encoder option 'video_preset' must be one of {', '.join(VIDEO_PRESETS)}")
+    if encoder['video_tune'] not in VIDEO_TUNES:
+        raise ValueError(f"Encoder option 'video_tune' must be one of {', '.join(VIDEO_TUNES)}")
+    if int(encoder['video_threads']) < 0:
+        raise ValueError("Encoder option 'video_threads' must be 0 or more")
+    encoder['target_bytes'] = int(settings['target_kb']) * 1024
+    encoder['report'] = settings['encoder_report']
+    return encoder
+
+def validate_renditions(renditions, default_quality):
+    """Return the renditions with their quality filled in; raises ValueError for invalid ones"""
+    validated = []
+    for rendition in renditions:
+        name = rendition.get('name', '')
+        if not name or not all(char.isalnum() or char in '-_' for char in name):
+            raise ValueError(f"Rendition name '{name}' must consist of letters, digits, '-' and '_'")
+        if name in [other['name'] for other in validated]:
+            raise ValueError(f"Rendition '{name}' is defined twice")
+        if int(rendition.get('max_size', 0)) < 1:
+            raise ValueError(f"Rendition '{name}' needs a max_size of at least 1 pixel")
+        if rendition.get('format', 'jpg') not in ['jpg', 'webp']:
+            raise ValueError(f"Rendition '{name}' must have format 'jpg' or 'webp'")
+        quality = int(rendition.get('quality', default_quality))
+        if not 1 <= quality <= 100:
+            raise ValueError(f"Rendition '{name}' must have a quality between 1 and 100")
+        validated.append({'name': name, 'max_size': int(rendition['max_size']), 'format': rendition.get('format', 'jpg'), 'quality': quality})
+    return validated
+
+def parse_rendition(value):
+    """Parse NAME:MAX_SIZE[:FORMAT[:QUALITY]] from the command line"""
+    parts = value.split(':')
+    if not 2 <= len(parts) <= 4 or not parts[1].isdigit() or (len(parts) == 4 and not parts[3].isdigit()):
+        raise argparse.ArgumentTypeError(f"expected NAME:MAX_SIZE[:FORMAT[:QUALITY]], got '{value}'")
+    rendition = {'name': parts[0], 'max_size': int(parts[1])}
+    if len(parts) > 2:
+        rendition['format'] = parts[2]
+    if len(parts) > 3:
+        rendition['quality'] = int(parts[3])
+    return rendition
+
+# Functions to encode images with the encoder profile
+def get_save_options(image_format, quality, encoder):
+    if image_format == 'jpg':
+        options = {'format': 'JPEG', 'quality': quality}
+        if encoder['jpeg_progressive'] == 'yes':
+            options['progressive'] = True
+        if encoder['jpeg_optimize'] == 'yes':
+            options['optimize'] = True
+        if encoder['jpeg_subsampling'] != 'default':
+            options['subsampling'] = encoder['jpeg_subsampling']
+        return options
+    return {'format': 'WEBP', 'quality': quality, 'method': int(encoder['webp_method'])}
+
+def encode_image(image, image_format, quality, encoder, exif=None):
+    """Encode an image in memory and return the encoded bytes and the quality used, lowered to meet the encoder's target size"""
+    if image_format == 'jpg' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    extra_options = {'exif': exif} if exif else {}
+
+    def encode(quality):
+        buffer = io.BytesIO()
+        image.save(buffer, **get_save_options(image_format, quality, encoder), **extra_options)
+        return buffer.getvalue()
+
+    data = encode(quality)
+    target_bytes = encoder['target_bytes']
+    if not target_bytes or len(data) <= target_bytes or quality <= TARGET_MIN_QUALITY:
+        return data, quality
+
+    # Binary search for the highest quality that fits, at most 7 extra encodes. If even
+    # TARGET_MIN_QUALITY does not fit, the image is encoded at that quality
+    low, high = TARGET_MIN_QUALITY, quality - 1
+    best = None
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = encode(middle)
+        if len(candidate) <= target_bytes:
+            best = (candidate, middle)
+            low = middle + 1
+        else:
+            high = middle - 1
+            smallest = (candidate, middle)
+    return best or smallest
+
+def save_encoded_image(image, path, image_format, quality, encoder, exif=None):
+    """Encode an image with the encoder profile into path and return the numbers for the encoder report"""
+    start_time = time.perf_counter()
+    data, used_quality = encode_image(image, image_format, quality, encoder, exif)
+    with open(path, 'wb') as f:
+        f.write(data)
+    stats = {'quality': used_quality, 'bytes': len(data), 'seconds': round(time.perf_counter() - start_time, 4)}
+
+    if encoder['report'] == 'yes':
+        # What the default encoder would have written at the configured quality, for comparison
+        start_time = time.perf_counter()
+        baseline, _ = encode_image(image, image_format, quality, {**ENCODER_PROFILES['default'], 'target_bytes': 0}, exif)
+        stats['baseline_bytes'] = len(baseline)
+        stats['baseline_seconds'] = round(time.perf_counter() - start_time, 4)
+    return stats
 
 # Function to convert image format
-def convert_image_format(image_path, target_format, quality=95):
+def convert_image_format(image_path, target_format, quality=95, output_path=None, encoder=None, image=None):
+    """Convert an image, or the already decoded image, into target_format and return (path, converted, encoder stats)"""
+    from PIL import Image
+
     current_format = image_path.suffix.lower()[1:]  # Remove the dot
     
     if current_format == target_format:
-        return image_path, False  # No conversion needed
+        return image_path, False, None  # No conversion needed
     
-    new_path = image_path.with_suffix(f'.{target_format}')
+    if image is None:
+        # Decoded first, so a broken input is quarantined rather than logged as a failed conversion
+        with open_image(image_path) as img:
+            return convert_image_format(image_path, target_format, quality, output_path, encoder, img)
+
+    new_path = output_path or image_path.with_suffix(f'.{target_format}')
+    encoder = encoder or get_encoder(DEFAULT_SETTINGS)
     try:
-        with Image.open(image_path) as img:
-            if target_format == 'jpg':
-                img.convert('RGB').save(new_path, "JPEG", quality=quality)
-            else:  # webp
-                img.save(new_path, "WEBP", quality=quality)
-            logging.info(f"Converted {image_path} to {target_format.upper()} with quality {quality}.")
-        return new_path, True
+        stats = save_encoded_image(image, new_path, target_format, quality, encoder)
+        logging.info(f"Converted {image_path} to {target_format.upper()} with quality {stats['quality']}.")
+        return new_path, True, stats
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+        raise PoisonInput(image_path, 'convert', str(e))
     except Exception as e:
         logging.error(f"Error converting {image_path} to {target_format.upper()}: {e}")
-        return None, False
+        return None, False, None
 
 # Helper function to check if file is a supported image format
+IMAGE_EXTENSIONS = {'.webp', '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif'}
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v'}
+
 def is_image_file(file_path):
     """Check if file is a supported image format (not video)"""
-    image_extensions = {'.webp', '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif'}
-    video_extensions = {'.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v'}
-    
     file_ext = file_path.suffix.lower()
     
-    if file_ext in video_extensions:
+    if file_ext in VIDEO_EXTENSIONS:
         return False
-    elif file_ext in image_extensions:
+    elif file_ext in IMAGE_EXTENSIONS:
         return True
     else:
         # Try to open with PIL to be sure
+        from PIL import Image
         try:
             with Image.open(file_path) as img:
                 img.verify()  # Verify it's a valid image
@@ -240,9 +494,8 @@ def is_image_file(file_path):
 # Helper function to check if file is a video format
 def is_video_file(file_path):
     """Check if file is a supported video format"""
-    video_extensions = {'.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v'}
     file_ext = file_path.suffix.lower()
-    return file_ext in video_extensions
+    return file_ext in VIDEO_EXTENSIONS
 
 # Helper function to determine file type
 def get_file_type(file_path):
@@ -270,8 +523,14 @@ def _convert_to_degrees(value):
 
 # Function to update EXIF data
 def update_exif(image_path, datetime_original, location=None, caption=None):
+    import piexif
+
     try:
-        exif_dict = piexif.load(image_path.as_posix())
+        try:
+            exif_dict = piexif.load(image_path.as_posix())
+        except ValueError:
+            # piexif refuses to load WebP files without EXIF data, start from an empty set
+            exif_dict = {}
 
         # Ensure the '0th' and 'Exif' directories are initialized
         if '0th' not in exif_dict:
@@ -317,6 +576,8 @@ def update_exif(image_path, datetime_original, location=None, caption=None):
 
 # Function to update IPTC information
 def update_iptc(image_path, caption):
+    from iptcinfo3 import IPTCInfo
+
     try:
         # Check if the file is a JPEG - IPTC works best with JPEG files
         file_path = Path(image_path)
@@ -354,26 +615,61 @@ def update_iptc(image_path, caption):
 
 # Function to handle deduplication
 def get_unique_filename(path):
-    if not path.exists():
-        return path
-    else:
-        prefix = path.stem
-        suffix = path.suffix
-        counter = 1
-        while path.exists():
+    """Return the first free name of path, path_1, path_2, ..., claimed by creating an empty file"""
+    prefix = path.stem
+    suffix = path.suffix
+    counter = 1
+    while True:
+        try:
+            with open(path, 'x'):
+                return path
+        except FileExistsError:
             path = path.with_name(f"{prefix}_{counter}{suffix}")
             counter += 1
-        return path
+
+# Same deduplication as get_unique_filename, against a set of taken names instead of the filesystem
+def get_unique_name(filename, taken):
+    if filename in taken:
+        prefix, suffix = os.path.splitext(filename)
+        counter = 1
+        while filename in taken:
+            filename = f"{prefix}_{counter}{suffix}"
+            counter += 1
+    taken.add(filename)
+    return filename
+
+# Cached masks and outlines, reused for every post a worker process handles.
+# Callers must not modify the returned images.
+@functools.lru_cache(maxsize=32)
+def get_rounded_mask(size, radius):
+    """Return an 'L' mask of the given size that is opaque inside a rectangle with rounded corners"""
+    from PIL import Image, ImageDraw
+
+    mask = Image.new('L', size, 0)
+    ImageDraw.Draw(mask).rounded_rectangle((0, 0, size[0], size[1]), radius, fill=255)
+    return mask
+
+@functools.lru_cache(maxsize=32)
+def get_rounded_outline(size, radius):
+    """Return a transparent tile with a black rectangle with rounded corners from (0, 0) to size, inclusive"""
+    from PIL import Image, ImageDraw
+
+    outline = Image.new('RGBA', (size[0] + 1, size[1] + 1), (0, 0, 0, 0))
+    ImageDraw.Draw(outline).rounded_rectangle((0, 0, size[0], size[1]), radius, fill=(0, 0, 0, 255))
+    return outline
 
 def combine_images_with_resizing(primary_path, secondary_path):
+    """Put the secondary image (a path or a decoded image) with rounded corners on top of the primary one"""
+    from PIL import Image
+
     # Parameters for rounded corners, outline and position
     corner_radius = 60
     outline_size = 7
     position = (55, 55)
 
     # Load primary and secondary images
-    primary_image = Image.open(primary_path)
-    secondary_image = Image.open(secondary_path)
+    primary_image = primary_path if isinstance(primary_path, Image.Image) else Image.open(primary_path)
+    secondary_image = secondary_path if isinstance(secondary_path, Image.Image) else Image.open(secondary_path)
 
     # Resize the secondary image using LANCZOS resampling for better quality
     scaling_factor = 1/3.33333333
@@ -386,35 +682,77 @@ def combine_images_with_resizing(primary_path, secondary_path):
     if resized_secondary_image.mode != 'RGBA':
         resized_secondary_image = resized_secondary_image.convert('RGBA')
 
-    # Create mask for rounded corners
-    mask = Image.new('L', (new_width, new_height), 0)
-    draw = ImageDraw.Draw(mask)
-    draw.rounded_rectangle((0, 0, new_width, new_height), corner_radius, fill=255)
-
     # Apply the rounded corners mask to the secondary image
-    resized_secondary_image.putalpha(mask)
+    resized_secondary_image.putalpha(get_rounded_mask((new_width, new_height), corner_radius))
 
     # Create a new blank image with the size of the primary image
     combined_image = Image.new("RGB", primary_image.size)
     combined_image.paste(primary_image, (0, 0))
 
     # Draw the black outline with rounded corners directly on the combined image
-    outline_layer = Image.new('RGBA', combined_image.size, (0, 0, 0, 0))  # Transparent layer for drawing the outline
-    draw = ImageDraw.Draw(outline_layer)
-    outline_box = [position[0] - outline_size, position[1] - outline_size, position[0] + new_width + outline_size, position[1] + new_height + outline_size]
-    draw.rounded_rectangle(outline_box, corner_radius + outline_size, fill=(0, 0, 0, 255))
-
-    # Merge the outline layer with the combined image
-    combined_image.paste(outline_layer, (0, 0), outline_layer)
+    outline = get_rounded_outline((new_width + 2 * outline_size, new_height + 2 * outline_size), corner_radius + outline_size)
+    combined_image.paste(outline, (position[0] - outline_size, position[1] - outline_size), outline)
 
     # Paste the secondary image onto the combined image using its alpha channel as the mask
     combined_image.paste(resized_secondary_image, position, resized_secondary_image)
 
     return combined_image
 
+# Function to burn the caption and/or date of a post into its combined image
+def add_text_overlay(image, taken_at, caption, mode, font_path=''):
+    """Draw the texts chosen by mode into a band at the bottom of image, in place"""
+    import text_overlay
+
+    texts = []
+    if mode in ['caption', 'both'] and caption:
+        texts.append((caption, text_overlay.CAPTION_MAX_LINES))
+    if mode in ['date', 'both']:
+        texts.append((taken_at.strftime('%Y-%m-%d'), 1))
+    if texts:
+        text_overlay.draw_text_band(image, texts, font_path or None)
+    return image
+
+# Functions for renditions: smaller copies of every output image, made from the image in memory
+def get_rendition_path(output_path, rendition):
+    return output_path.parent / rendition['name'] / f"{output_path.stem}.{rendition['format']}"
+
+def save_renditions(image, output_path, role, record, paths, settings):
+    """Save all renditions of an output image from its decoded pixels and return how many were saved"""
+    from PIL import Image
+
+    with Image.open(output_path) as img:  # Only reads the header
+        exif = img.info.get('exif')
+    # WebP keeps the EXIF block without the header a JPEG APP1 segment needs
+    if exif and not exif.startswith(b'Exif\x00\x00'):
+        exif = b'Exif\x00\x00' + exif
+    # Renditions have their own quality, the target size is for full-size images
+    encoder = {**get_encoder(settings), 'target_bytes': 0}
+
+    if image.mode not in ['RGB', 'RGBA', 'L']:
+        image = image.convert('RGB')
+    width, height = image.size
+    current = image
+    for rendition in sorted(settings['renditions'], key=lambda rendition: rendition['max_size'], reverse=True):
+        scale = min(1.0, rendition['max_size'] / max(width, height))
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if current.size != size:
+            current = current.resize(size, Image.Resampling.LANCZOS)
+
+        rendition_path = get_rendition_path(output_path, rendition)
+        output_role = f"{role}@{rendition['name']}"
+        record['encoding'][output_role] = save_encoded_image(current, rendition_path, rendition['format'], rendition['quality'], encoder, exif)
+        update_iptc(str(rendition_path), record['caption'])
+
+        record['outputs'][output_role] = get_manifest_path(rendition_path, paths)
+        record['output_info'][output_role] = describe_output(rendition_path)
+    logging.info(f"Saved {len(settings['renditions'])} renditions of {output_path.name}.")
+    return len(settings['renditions'])
+
 # Function to create styled overlay image for video processing
 def create_styled_overlay_image(secondary_image_path, video_width, output_path=None):
     """Create a styled overlay image with rounded corners and black outline, scaled to video width"""
+    from PIL import Image
+
     if output_path is None:
         output_path = tempfile.mktemp(suffix='.png')
     
@@ -441,23 +779,17 @@ def create_styled_overlay_image(secondary_image_path, video_width, output_path=N
     padding = outline_size * 2
     canvas_width = target_overlay_width + padding
     canvas_height = target_overlay_height + padding
-    canvas = Image.new('RGBA', (canvas_width, canvas_height), (0, 0, 0, 0))
     
-    # Draw the black outline
-    draw = ImageDraw.Draw(canvas)
-    outline_box = [0, 0, canvas_width, canvas_height]
-    draw.rounded_rectangle(outline_box, corner_radius + outline_size, fill=(0, 0, 0, 255))
+    # Start from the black outline, cropped to the canvas
+    outline = get_rounded_outline((canvas_width, canvas_height), corner_radius + outline_size)
+    canvas = outline.crop((0, 0, canvas_width, canvas_height))
     
     # Create mask for rounded corners on the content
     if resized_secondary_image.mode != 'RGBA':
         resized_secondary_image = resized_secondary_image.convert('RGBA')
     
-    mask = Image.new('L', (target_overlay_width, target_overlay_height), 0)
-    mask_draw = ImageDraw.Draw(mask)
-    mask_draw.rounded_rectangle((0, 0, target_overlay_width, target_overlay_height), corner_radius, fill=255)
-    
     # Apply the rounded corners mask
-    resized_secondary_image.putalpha(mask)
+    resized_secondary_image.putalpha(get_rounded_mask((target_overlay_width, target_overlay_height), corner_radius))
     
     # Paste the content onto the canvas with the outline
     content_position = (outline_size, outline_size)
@@ -467,9 +799,21 @@ def create_styled_overlay_image(secondary_image_path, video_width, output_path=N
     canvas.save(output_path, 'PNG')
     return output_path
 
+# Function to check once per process whether FFmpeg can be run at all
+@functools.lru_cache(maxsize=None)
+def ffmpeg_available():
+    for tool in ['ffmpeg', 'ffprobe']:
+        try:
+            subprocess.run([tool, '-version'], capture_output=True, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            logging.error(f"{tool} could not be run, combined BTS videos will not be created")
+            return False
+    return True
+
 # Function to combine video with image overlay using FFmpeg
-def combine_video_with_image(primary_video_path, secondary_image_path, output_path, crf=18):
-    """Combine video with image overlay using FFmpeg"""
+def combine_video_with_image(primary_video_path, secondary_image_path, output_path, crf=18, preset='medium', tune='none', threads=0,
+                             timeout=None):
+    """Combine video with image overlay using FFmpeg; raises PoisonInput if ffprobe or ffmpeg takes longer than timeout seconds"""
     try:
         # Get video dimensions using ffprobe
         probe_cmd = [
@@ -480,8 +824,7 @@ def combine_video_with_image(primary_video_path, secondary_image_path, output_pa
             str(primary_video_path)
         ]
         
-        probe_result = subprocess.run(probe_cmd, capture_output=True, text=True, check=True)
-        import json
+        probe_result = subprocess.run(probe_cmd, capture_output=True, text=True, check=True, timeout=timeout)
         probe_data = json.loads(probe_result.stdout)
         
         # Find video stream and get dimensions
@@ -511,13 +854,19 @@ def combine_video_with_image(primary_video_path, secondary_image_path, output_pa
             '-c:a', 'copy',                 # Copy audio without re-encoding
             '-c:v', 'libx264',              # Use H.264 for compatibility
             '-crf', str(crf),               # Configurable quality setting
-            '-preset', 'medium',            # Balance between speed and compression
+            '-preset', preset,              # Balance between speed and compression
+        ]
+        if tune != 'none':
+            cmd += ['-tune', tune]
+        if threads:
+            cmd += ['-threads', str(threads)]
+        cmd += [
             '-y',                           # Overwrite output file
             str(output_path)
         ]
         
         # Run the ffmpeg command
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=timeout)
         
         # Clean up temporary overlay file
         os.unlink(overlay_path)
@@ -525,6 +874,12 @@ def combine_video_with_image(primary_video_path, secondary_image_path, output_pa
         logging.info(f"Successfully created combined video: {output_path} with CRF {crf}")
         return True
         
+    except subprocess.TimeoutExpired:
+        # subprocess.run has killed the hung process already
+        if 'overlay_path' in locals():
+            os.unlink(overlay_path)
+        raise PoisonInput(primary_video_path, 'video', f"FFmpeg did not finish within {timeout}s")
+
     except subprocess.CalledProcessError as e:
         logging.error(f"FFmpeg command failed: {e}")
         logging.error(f"FFmpeg stderr: {e.stderr}")
@@ -547,8 +902,10 @@ def combine_video_with_image(primary_video_path, secondary_image_path, output_pa
         return False
 
 # Function to add metadata to video files (basic implementation)
-def update_video_metadata(video_path, datetime_original, location=None, caption=None):
-    """Add metadata to video file using FFmpeg"""
+def update_video_metadata(video_path, datetime_original, location=None, caption=None, timeout=None):
+    """Add metadata to video file using FFmpeg; raises PoisonInput if it takes longer than timeout seconds"""
+    import ffmpeg
+
     try:
         # For now, we'll use a simple approach with FFmpeg metadata
         # Note: Video metadata is more limited than image EXIF
@@ -573,14 +930,18 @@ def update_video_metadata(video_path, datetime_original, location=None, caption=
             **{f'metadata:{k}': v for k, v in metadata_args.items()}
         )
         
-        # Run with error handling
-        ffmpeg.run(out, overwrite_output=True, quiet=True, capture_stdout=True, capture_stderr=True)
+        # Run with error handling, killing FFmpeg if it hangs
+        subprocess.run(ffmpeg.compile(out, overwrite_output=True), capture_output=True, check=True, timeout=timeout)
         
         # Replace original with updated file
         shutil.move(temp_output, video_path)
         logging.info(f"Updated video metadata for {video_path}")
         
-    except ffmpeg.Error as e:
+    except subprocess.TimeoutExpired:
+        if os.path.exists(temp_output):
+            os.unlink(temp_output)
+        raise PoisonInput(video_path, 'metadata', f"FFmpeg did not finish within {timeout}s")
+    except subprocess.CalledProcessError as e:
         logging.warning(f"FFmpeg error updating metadata for {video_path}, continuing without metadata: {e}")
         # Clean up temporary file on error
         try:
@@ -597,6 +958,139 @@ def update_video_metadata(video_path, datetime_original, location=None, caption=
         except:
             pass
 
+# Functions to measure how fast this machine encodes combined BTS videos, and to pick the
+# preset and the number of parallel encodes that meet a throughput target or a time budget
+VIDEO_CALIBRATION_PATH = Path.home() / '.bereal-video-calibration.json'
+CALIBRATION_PRESETS = ['ultrafast', 'veryfast', 'faster', 'fast', 'medium', 'slow']
+CALIBRATION_CLIP_SECONDS = 3
+CALIBRATION_CLIP_FPS = 30
+CALIBRATION_TIMEOUT = 300  # Seconds for one FFmpeg run of the calibration
+FFPROBE_TIMEOUT = 60
+
+def get_thread_counts(cpus):
+    """1, 2, 4, ... below the number of CPUs, and the number of CPUs itself"""
+    counts = []
+    threads = 1
+    while threads < cpus:
+        counts.append(threads)
+        threads *= 2
+    counts.append(cpus)
+    return counts
+
+def make_calibration_clip(folder):
+    """Write a synthetic BTS clip (a moving test pattern at BTS size) and a back image to overlay on it"""
+    from PIL import Image
+
+    clip_path = folder / 'clip.mp4'
+    width, height = BTS_VIDEO_SIZE
+    try:
+        subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi',
+                        '-i', f'testsrc2=size={width}x{height}:rate={CALIBRATION_CLIP_FPS}:duration={CALIBRATION_CLIP_SECONDS}',
+                        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '12', '-pix_fmt', 'yuv420p', '-y', str(clip_path)],
+                       capture_output=True, check=True, timeout=CALIBRATION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise ValueError(f"Writing the calibration clip took longer than {CALIBRATION_TIMEOUT}s")
+    image_path = folder / 'back.jpg'
+    Image.effect_mandelbrot(BEREAL_IMAGE_SIZE, (-2.0, -1.5, 1.0, 1.5), 100).convert('RGB').save(image_path, quality=90)
+    return clip_path, image_path
+
+def calibrate_video(calibration_path, crf=18):
+    """Encode the synthetic clip with every calibration preset and thread count, and save the measured fps and size"""
+    if not ffmpeg_available():
+        raise ValueError("FFmpeg is needed to calibrate video encoding")
+    cpus = os.cpu_count() or 1
+    frames = CALIBRATION_CLIP_SECONDS * CALIBRATION_CLIP_FPS
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bereal-calibration-') as folder:
+        folder = Path(folder)
+        clip_path, image_path = make_calibration_clip(folder)
+        for preset in CALIBRATION_PRESETS:
+            for threads in get_thread_counts(cpus):
+                # As many encodes at once as fit on the CPUs, so the fps include their competition
+                jobs = max(1, cpus // threads)
+                outputs = [folder / f"{preset}-{threads}-{job}.mp4" for job in range(jobs)]
+                start_time = time.perf_counter()
+                try:
+                    with ThreadPoolExecutor(max_workers=jobs) as executor:
+                        success = all(executor.map(lambda output: combine_video_with_image(clip_path, image_path, output, crf, preset, 'none',
+                                                                                           threads, CALIBRATION_TIMEOUT), outputs))
+                except PoisonInput as e:
+                    raise ValueError(f"Encoding the calibration clip with preset {preset} failed: {e.reason}")
+                seconds = time.perf_counter() - start_time
+                if not success:
+                    raise ValueError(f"Encoding the calibration clip with preset {preset} failed")
+                result = {
+                    'preset': preset,
+                    'threads': threads,
+                    'jobs': jobs,
+                    'fps': round(frames / seconds, 2),  # Of one encode, while all jobs run
+                    'bytes_per_frame': round(sum(output.stat().st_size for output in outputs) / jobs / frames),
+                }
+                results.append(result)
+                logging.info(f"Preset {preset}, {jobs} x {threads} threads: {result['fps']} fps per video, "
+                             f"{result['fps'] * jobs:.1f} fps in total, {format_bytes(result['bytes_per_frame'])} per frame")
+
+    version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=FFPROBE_TIMEOUT).stdout.split('\n')[0]
+    write_json_atomic(Path(calibration_path), {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'cpus': cpus,
+        'ffmpeg': version,
+        'clip': {'size': list(BTS_VIDEO_SIZE), 'fps': CALIBRATION_CLIP_FPS, 'seconds': CALIBRATION_CLIP_SECONDS, 'crf': crf},
+        'results': results,
+    })
+    logging.info(f"Video calibration saved: {calibration_path}")
+
+def load_video_calibration(calibration_path):
+    with open(calibration_path, encoding='utf8') as f:
+        calibration = json.load(f)
+    if calibration['cpus'] != os.cpu_count():
+        logging.warning(f"The video calibration was made on a machine with {calibration['cpus']} CPUs, this one has {os.cpu_count()}")
+    return calibration
+
+def parse_video_target(value):
+    """Parse a positive number for --video-fps and --video-budget"""
+    try:
+        target = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number, got '{value}'")
+    if not target > 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got '{value}'")
+    return target
+
+def get_video_frames(video_path):
+    """Number of frames of a video according to ffprobe, 0 if it cannot be read"""
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'quiet', '-print_format', 'json', '-select_streams', 'v:0',
+                                 '-show_entries', 'stream=nb_frames,avg_frame_rate,duration', str(video_path)],
+                                capture_output=True, text=True, check=True, timeout=FFPROBE_TIMEOUT)
+        stream = json.loads(result.stdout)['streams'][0]
+        if stream.get('nb_frames', 'N/A') != 'N/A':
+            return int(stream['nb_frames'])
+        numerator, denominator = stream['avg_frame_rate'].split('/')
+        return round(float(stream['duration']) * int(numerator) / int(denominator))
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired, ValueError, KeyError, IndexError, ZeroDivisionError):
+        logging.warning(f"Could not count the frames of {video_path}")
+        return 0
+
+def choose_video_encoding(calibration, total_frames, workers, target_fps=None, budget_seconds=None):
+    """Pick the calibrated preset, threads and parallel encodes that reach the fps or time budget with the smallest files"""
+    required_fps = target_fps or total_frames / budget_seconds
+    candidates = []
+    for result in calibration['results']:
+        jobs = min(result['jobs'], workers)
+        candidates.append({**result, 'jobs': jobs, 'total_fps': result['fps'] * jobs})
+    # If no combination is fast enough, the fastest one is used
+    fast_enough = [candidate for candidate in candidates if candidate['total_fps'] >= required_fps]
+    if fast_enough:
+        choice = min(fast_enough, key=lambda candidate: (candidate['bytes_per_frame'], -candidate['total_fps']))
+    else:
+        choice = max(candidates, key=lambda candidate: candidate['total_fps'])
+        logging.warning(f"No calibrated video encoding reaches {required_fps:.1f} fps, using the fastest one "
+                        f"({choice['total_fps']:.1f} fps)")
+    choice['required_fps'] = required_fps
+    choice['estimated_seconds'] = total_frames / choice['total_fps']
+    return choice
+
 # Function to clean up backup files left behind by iptcinfo3
 def remove_backup_files(directory):
     # List all files in the given directory
@@ -612,72 +1106,1034 @@ def remove_backup_files(directory):
             except Exception as e:
                 print(f"Failed to remove backup file {file_path}: {e}")
 
-# Load the JSON file
-try:
+# Function to load the JSON file
+def load_posts(json_path):
     with open(json_path, encoding="utf8") as f:
-        data = json.load(f)
-except FileNotFoundError:
-    logging.error("JSON file not found. Please check the path.")
-    exit()
+        return json.load(f)
 
-# Process files
-for entry in data:
+# Function to index a folder once instead of checking every file on its own
+def index_folder(folder_path):
+    """Return a dict of filename -> size in bytes for all files in the folder (empty if missing)"""
+    index = {}
     try:
-        # Extract filenames from the posts.json structure
-        # posts.json uses: primary, secondary, optional btsMedia
-        front_filename = Path(entry['primary']['path']).name
-        back_filename = Path(entry['secondary']['path']).name
-        
-        # Check if there's a behind-the-scenes video
-        bts_filename = None
-        has_bts = 'btsMedia' in entry and entry['btsMedia'] is not None
-        if has_bts:
-            bts_filename = Path(entry['btsMedia']['path']).name
+        with os.scandir(folder_path) as entries:
+            for dir_entry in entries:
+                if dir_entry.is_file():
+                    index[dir_entry.name] = dir_entry.stat().st_size
+    except FileNotFoundError:
+        pass
+    return index
+
+def index_export(paths):
+    """Index the input and output folders of an export"""
+    return {
+        'photo_folder': index_folder(paths['photo_folder']),
+        'bereal_folder': index_folder(paths['bereal_folder']),
+        'output_folder': index_folder(paths['output_folder']),
+        'output_folder_combined': index_folder(paths['output_folder_combined']),
+    }
+
+# Function to resolve the input files of a posts.json entry
+def resolve_entry(entry, paths, folder_index, settings):
+    """Find the files of one posts.json entry and decide which of them will be processed"""
+    # Extract filenames from the posts.json structure
+    # posts.json uses: primary, secondary, optional btsMedia
+    front_filename = Path(entry['primary']['path']).name
+    back_filename = Path(entry['secondary']['path']).name
+
+    # Check if there's a behind-the-scenes video
+    bts_filename = None
+    has_bts = 'btsMedia' in entry and entry['btsMedia'] is not None
+    if has_bts:
+        bts_filename = Path(entry['btsMedia']['path']).name
+
+    # If files not found in main folder, try the older folder
+    folder_key = 'photo_folder'
+    if front_filename not in folder_index['photo_folder']:
+        folder_key = 'bereal_folder'
+    folder = paths[folder_key]
+
+    front_path = folder / front_filename
+    back_path = folder / back_filename
+    bts_path = folder / bts_filename if has_bts else None
+
+    # Determine file types
+    front_type = get_file_type(front_path)
+    back_type = get_file_type(back_path)
+    bts_type = get_file_type(bts_path) if has_bts else None
+
+    # Skip bts videos if user chose not to process them or if bts file type is unknown
+    bts_skip_reason = None
+    if has_bts and settings['process_videos'] == 'no':
+        bts_skip_reason = 'user choice'
+        has_bts = False  # Process as regular image combination
+    elif has_bts and bts_type == 'unknown':
+        bts_skip_reason = 'unknown file type'
+        has_bts = False
+
+    return {
+        'taken_at': datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ"),
+        'location': entry.get('location'),  # This will be None if 'location' is not present
+        'caption': entry.get('caption'),  # This will be None if 'caption' is not present
+        'front_path': front_path,
+        'back_path': back_path,
+        'bts_path': bts_path,
+        'front_type': front_type,
+        'back_type': back_type,
+        'bts_type': bts_type,
+        'has_bts': has_bts,
+        'bts_skip_reason': bts_skip_reason,
+        'folder_key': folder_key,
+    }
+
+# Function to build the name of a processed single image or BTS video
+def get_output_filename(taken_at, role, source_path, settings):
+    """Return the output filename for a single file, before deduplication"""
+    time_str = taken_at.strftime("%Y-%m-%dT%H-%M-%S")
+    original_filename_without_extension = source_path.stem
+
+    # Determine the actual file extension based on conversion
+    actual_extension = source_path.suffix.lower()
+    if role != 'bts' and settings['convert_format'] == 'yes':
+        actual_extension = f".{settings['target_format']}"
+
+    if settings['keep_original_filename'] == 'yes':
+        return f"{time_str}_{role}_{original_filename_without_extension}{actual_extension}"
+    return f"{time_str}_{role}{actual_extension}"
+
+# Function to build the names of the combined image and video of a post
+def get_combined_filenames(front_filename, base_front_filename):
+    """Return the combined image and video filenames for a processed front image"""
+    timestamp = Path(front_filename).stem.split('_')[0]
+    # The counter deduplication added to the front image, so posts of the same second keep their own combined outputs
+    dedupe_suffix = Path(front_filename).stem[len(Path(base_front_filename).stem):]
+    return f"{timestamp}_combined{dedupe_suffix}.jpg", f"{timestamp}_bts_combined{dedupe_suffix}.mp4"
+
+# Rough output/input size ratios, only used to estimate the size of a run in the plan
+ESTIMATED_SIZE_RATIOS = {
+    ('webp', 'jpg'): 1.6,
+    ('webp', 'jpeg'): 1.6,
+    ('jpg', 'webp'): 0.6,
+    ('jpeg', 'webp'): 0.6,
+}
 
-        front_path = photo_folder / front_filename
-        back_path = photo_folder / back_filename
-        bts_path = None
-        if has_bts:
-            bts_path = photo_folder / bts_filename
-
-        # If files not found in main folder, try the older folder
-        if not os.path.exists(front_path):
-            front_path = bereal_folder / front_filename
-            back_path = bereal_folder / back_filename
-            if has_bts:
-                bts_path = bereal_folder / bts_filename
-
-        # Determine file types
-        front_type = get_file_type(front_path)
-        back_type = get_file_type(back_path)
-        bts_type = None
-        if has_bts and bts_path:
-            bts_type = get_file_type(bts_path)
+def estimate_output_bytes(source_size, source_path, target_format):
+    source_format = source_path.suffix.lower()[1:]
+    return int(source_size * ESTIMATED_SIZE_RATIOS.get((source_format, target_format), 1.0))
+
+# Renditions are estimated for the size of BeReal images, the plan does not open any image
+BEREAL_IMAGE_MAX_SIZE = 2000
+
+def estimate_rendition_bytes(output_bytes, output_path, rendition):
+    scale = min(1.0, rendition['max_size'] / BEREAL_IMAGE_MAX_SIZE)
+    return int(estimate_output_bytes(output_bytes, output_path, rendition['format']) * scale * scale)
+
+def format_bytes(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024 or unit == 'GB':
+            break
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} {unit}" if unit != 'B' else f"{num_bytes} B"
+
+# Function to build the work plan of an export without touching any image
+def plan_export(paths, data, settings, folder_index, shard=None):
+    """Return the list of outputs a run with these settings would create, mirroring the processing loop"""
+    plan = {
+        'posts': [],
+        'skipped': [],
+        'outputs': 0,
+        'conversions': 0,
+        'videos': 0,
+        'estimated_bytes': 0,
+    }
+
+    # Names that are taken already, so deduplication can be predicted. Shards name their
+    # outputs from posts.json alone (see assign_output_names), so they start from nothing.
+    taken = {
+        'output_folder': set(folder_index['output_folder']) if shard is None else set(),
+        'output_folder_combined': set(folder_index['output_folder_combined']) if shard is None else set(),
+    }
+
+    for entry in data:
+        in_shard = shard is None or get_shard(entry, shard[1]) == shard[0]
+        try:
+            post = resolve_entry(entry, paths, folder_index, settings)
+        except Exception as e:
+            if in_shard:
+                plan['skipped'].append(f"{entry.get('takenAt')}: invalid entry ({e})")
+            continue
+
+        if post['front_type'] == 'unknown' or post['back_type'] == 'unknown':
+            if in_shard:
+                plan['skipped'].append(f"{post['front_path'].name}, {post['back_path'].name}: unknown file types")
+            continue
+
+        singles = [('front', post['front_path']), ('back', post['back_path'])]
+        if post['has_bts']:
+            singles.append(('bts', post['bts_path']))
+
+        filenames = {}
+        for role, source_path in singles:
+            base_filename = get_output_filename(post['taken_at'], role, source_path, settings)
+            filenames[role] = get_unique_name(base_filename, taken['output_folder'])
+            if role == 'front':
+                combined_filename, bts_combined_filename = get_combined_filenames(filenames[role], base_filename)
+
+        if not in_shard:
+            continue
+        sizes = folder_index[post['folder_key']]
+        if post['front_path'].name not in sizes:
+            plan['skipped'].append(f"{post['front_path'].name}: file not found")
+            continue
+
+        outputs = []
+        for role, source_path in singles:
+            source_size = sizes.get(source_path.name, 0)
+            action = 'copy'
+            estimated_bytes = source_size
+            if role != 'bts' and settings['convert_format'] == 'yes' and source_path.suffix.lower()[1:] != settings['target_format']:
+                action = f"convert to {settings['target_format'].upper()}"
+                estimated_bytes = estimate_output_bytes(source_size, source_path, settings['target_format'])
+                plan['conversions'] += 1
+            outputs.append((paths['output_folder'] / filenames[role], action, estimated_bytes))
+
+        if settings['create_combined_images'] == 'yes':
+            primary_size = sizes.get(post['front_path'].name, 0)
+            outputs.append((paths['output_folder_combined'] / combined_filename, 'combine images',
+                            estimate_output_bytes(primary_size, post['front_path'], 'jpg')))
+            if post['has_bts']:
+                outputs.append((paths['output_folder_combined'] / bts_combined_filename, 'encode video',
+                                sizes.get(post['bts_path'].name, 0)))
+                plan['videos'] += 1
+
+        # Renditions of the image outputs
+        for output_path, _, estimated_bytes in list(outputs):
+            if not is_video_file(output_path):
+                for rendition in settings['renditions']:
+                    outputs.append((get_rendition_path(output_path, rendition), f"rendition {rendition['name']}",
+                                    estimate_rendition_bytes(estimated_bytes, output_path, rendition)))
+
+        plan['outputs'] += len(outputs)
+        plan['estimated_bytes'] += sum(estimated_bytes for _, _, estimated_bytes in outputs)
+        plan['posts'].append({'post': post, 'outputs': outputs})
+
+    return plan
+
+def print_plan(plan):
+    print(STYLING["BOLD"] + "Work plan:" + STYLING["RESET"])
+    for planned in plan['posts']:
+        post = planned['post']
+        print(f"{post['taken_at'].strftime('%Y-%m-%d %H:%M:%S')}  {post['front_path'].name} + {post['back_path'].name}"
+              + (f" + {post['bts_path'].name}" if post['has_bts'] else "")
+              + (f" (BTS video skipped: {post['bts_skip_reason']})" if post['bts_skip_reason'] else ""))
+        for output_path, action, estimated_bytes in planned['outputs']:
+            print(f"    {output_path.parent.name}/{output_path.name}  [{action}, ~{format_bytes(estimated_bytes)}]")
+    for skipped in plan['skipped']:
+        print(STYLING["RED"] + f"Skipping {skipped}" + STYLING["RESET"])
+
+    print(STYLING["BOLD"] + "\nSummary:" + STYLING["RESET"])
+    print(f"Posts to process: {len(plan['posts'])}")
+    print(f"Posts skipped: {len(plan['skipped'])}")
+    print(f"Outputs to create: {plan['outputs']}")
+    print(f"Images to convert: {plan['conversions']}")
+    print(f"Videos to encode: {plan['videos']}")
+    print(f"Estimated output size: {format_bytes(plan['estimated_bytes'])}")
+
+# Functions to split the posts of one export across several machines
+def get_post_key(entry):
+    """Identify a post by its capture time and primary image, independent of where the export lives"""
+    return f"{entry['takenAt']}|{entry['primary']['path']}"
+
+def get_shard(entry, shard_count):
+    """Return the shard (0 to shard_count - 1) a posts.json entry belongs to; the same on every machine"""
+    try:
+        key = get_post_key(entry)
+    except (KeyError, TypeError):
+        return 0  # Invalid entries are all reported by the first shard
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+def parse_shard(value):
+    """Parse 'i/N' for --shard"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and N-1, got '{value}'")
+    return index, count
+
+def assign_output_names(posts, settings, taken):
+    """Give every post the names of its singles in posts.json order, skipping the names in taken"""
+    for post in posts:
+        if post['front_type'] == 'unknown' or post['back_type'] == 'unknown':
+            continue
+        roles = [('front', post['front_path']), ('back', post['back_path'])]
+        if post['has_bts']:
+            roles.append(('bts', post['bts_path']))
+        post['output_names'] = {
+            role: get_unique_name(get_output_filename(post['taken_at'], role, source_path, settings), taken)
+            for role, source_path in roles
+        }
+
+def reuse_output_names(posts, manifest_path, paths, settings):
+    """Give posts that are processed again the output names of their records in the manifest"""
+    try:
+        with open(manifest_path, encoding='utf8') as f:
+            records = {record['key']: record for record in json.load(f)['posts']}
+    except FileNotFoundError:
+        return
+    redone = set()
+    for post in posts:
+        record = records.get(post['key'])
+        if record is None or record.get('archive'):
+            continue
+        names = post.setdefault('output_names', {})
+        for role, source_path in [('front', post['front_path']), ('back', post['back_path']), ('bts', post['bts_path'])]:
+            if role in record['outputs']:
+                # The settings of the new run may give the output another format
+                filename = get_output_filename(post['taken_at'], role, source_path, settings)
+                names[role] = Path(record['outputs'][role]).stem + Path(filename).suffix
+        # The singles are written over under their old names, the other old outputs are removed
+        reused = {Path(record['outputs'][role]).with_name(names[role]) for role in names if role in record['outputs']}
+        for output in record['outputs'].values():
+            redone.add(output)
+            if Path(output) not in reused:
+                (paths['files_root'] / output).unlink(missing_ok=True)
+
+    # So the next --verify takes the new files as they are
+    checksums_path = paths['output_root'] / 'checksums.sha256'
+    if redone and checksums_path.exists():
+        lines = checksums_path.read_text(encoding='utf8').splitlines(keepends=True)
+        checksums_path.write_text(''.join(line for line in lines if line.rstrip('\n').split('  ', 1)[1] not in redone), encoding='utf8')
+
+def get_post_output_path(post, role, path):
+    """Return the output path of a single: the name given in prepare_export, otherwise the first free name"""
+    if role in post.get('output_names', {}):
+        return path.with_name(post['output_names'][role])
+    return get_unique_filename(path)
+
+# Functions for the run manifest, listing the outputs of every post
+def get_manifest_path(path, paths):
+    return Path(path).relative_to(paths['files_root']).as_posix()
+
+def describe_output(path):
+    """Return the size in bytes and, for images, the dimensions of an output file"""
+    from PIL import Image
+
+    info = {'bytes': path.stat().st_size, 'width': None, 'height': None}
+    if not is_video_file(path):
+        with Image.open(path) as img:  # Only reads the header
+            info['width'], info['height'] = img.size
+    return info
+
+def get_manifest_filename(shard):
+    if shard is None:
+        return 'manifest.json'
+    return f"manifest-shard-{shard[0]}-of-{shard[1]}.json"
+
+def write_json_atomic(path, data):
+    temp_path = path.with_name(path.name + '.tmp')
+    with open(temp_path, 'w', encoding='utf8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+def write_manifest(state, settings):
+    """Write the manifest of a run and return it; a --posts run updates the records of its posts in the existing manifest"""
+    paths = state['paths']
+    manifest_path = paths['output_root'] / get_manifest_filename(state['shard'])
+    manifest = {
+        'export': paths['export'],
+        'posts_json_sha1': state['posts_json_sha1'],
+        'shard': list(state['shard']) if state['shard'] else None,
+        'entries': state['entries'],
+        'entries_total': state['entries_total'],
+        'settings': {key: value for key, value in settings.items() if key != 'video_encoding'},
+        'counters': state['counters'],
+    }
+    if 'video_encoding' in settings:
+        manifest['video_encoding'] = settings['video_encoding']
+    records = state['records']
+    if state.get('posts_subset') and manifest_path.exists():
+        with open(manifest_path, encoding='utf8') as f:
+            previous = json.load(f)
+        previous_records = {record['key']: record for record in previous['posts']}
+        counters = {**new_counters(), **previous['counters']}
+        for record in records:
+            replaced = previous_records.pop(record['key'], None)
+            if replaced is not None:
+                add_counters(counters, {key: -value for key, value in replaced.get('counters', {}).items()})
+        add_counters(counters, state['counters'])
+        manifest['counters'] = counters
+        records = list(previous_records.values()) + records
+        if not state['subset_of_posts_json']:
+            for key in ['posts_json_sha1', 'entries', 'entries_total']:
+                manifest[key] = previous[key]
+    manifest['encoding'] = summarize_encoding(records)
+    manifest['quarantine'] = get_quarantine(records)
+    manifest['posts'] = sorted(records, key=lambda record: record['index'])
+    write_json_atomic(manifest_path, manifest)
+    logging.info(f"Manifest written: {manifest_path}")
+    return manifest
+
+# Function to add the posts of a manifest to the SQLite catalog
+def update_catalog(manifest, output_root, catalog_path=None):
+    import posts_catalog
+
+    catalog_path = catalog_path or Path(output_root) / 'catalog.sqlite'
+    try:
+        connection = posts_catalog.connect(catalog_path)
+        try:
+            count = posts_catalog.add_manifest(connection, manifest, output_root)
+        finally:
+            connection.close()
+        logging.info(f"Catalog updated with {count} posts: {catalog_path}")
+    except Exception as e:
+        logging.error(f"Failed to update catalog {catalog_path}: {e}")
+
+# Functions for the archive output sink. The workers write the outputs of a post to a
+# staging folder on local disk, and the main process streams them into one archive at a
+# time, so the output folder only sees a few large sequential writes.
+ARCHIVE_DEFAULT_MAX_MB = 4096
+
+def get_archive_filename(shard, number, archive_format):
+    prefix = 'outputs' if shard is None else f"outputs-shard-{shard[0]}-of-{shard[1]}"
+    return f"{prefix}-{number:04d}.{archive_format}"
+
+def open_next_archive(state):
+    """Start the next archive of an export, after the ones earlier runs left behind"""
+    archive = state['archive']
+    while True:
+        archive['number'] += 1
+        archive_path = state['paths']['output_root'] / get_archive_filename(state['shard'], archive['number'], archive['format'])
+        if not archive_path.exists():
+            break
+    if archive['format'] == 'tar':
+        archive['file'] = tarfile.open(archive_path, 'w', format=tarfile.PAX_FORMAT)
+    else:
+        # The outputs are JPEG, WebP and MP4 files already, deflating them gains nothing
+        archive['file'] = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    archive['path'] = archive_path
+    archive['members'] = {}
+
+def close_archive(state):
+    """Finish the current archive and write its index of member offsets next to it"""
+    archive = state['archive']
+    if archive['file'] is None:
+        return
+    archive['file'].close()
+    archive['file'] = None
+    write_json_atomic(archive['path'].with_name(archive['path'].name + '.index.json'), {
+        'archive': archive['path'].name,
+        'format': archive['format'],
+        'members': archive['members'],
+    })
+    logging.info(f"Archive written: {archive['path']} ({len(archive['members'])} files)")
+
+def get_archive_size(archive):
+    if archive['format'] == 'tar':
+        return archive['file'].offset
+    return archive['file'].fp.tell()
+
+def add_to_archive(archive, staged_path, member):
+    """Append one staged file to the archive and record where its data starts, so it can be read with a single seek"""
+    size = staged_path.stat().st_size
+    if archive['format'] == 'tar':
+        tar = archive['file']
+        info = tar.gettarinfo(staged_path, arcname=member)
+        with open(staged_path, 'rb') as f:
+            tar.addfile(info, f)
+        # The data ends the member, padded to whole blocks
+        offset = tar.offset - -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    else:
+        archive['file'].write(staged_path, member)
+        info = archive['file'].getinfo(member)
+        # The data follows the 30-byte local file header, the name and the extra field
+        offset = info.header_offset + 30 + len(info.filename.encode('utf-8')) + len(info.extra)
+    archive['members'][member] = {'offset': offset, 'size': size}
+
+def archive_outputs(state, record):
+    """Move the staged outputs of one post into the current archive, starting a new archive when it is full"""
+    archive = state['archive']
+    if not record['outputs']:
+        return
+    if archive['file'] is None or get_archive_size(archive) >= archive['max_bytes']:
+        close_archive(state)
+        open_next_archive(state)
+    for member in record['outputs'].values():
+        staged_path = state['paths']['files_root'] / member
+        add_to_archive(archive, staged_path, member)
+        # Keep the empty file, so the name stays taken for the posts still to come
+        os.truncate(staged_path, 0)
+    record['archive'] = archive['path'].name
+
+def merge_manifests(manifest_paths):
+    """Combine the manifests of all shards of one run into one; raises ValueError if they do not add up"""
+    manifests = []
+    for manifest_path in manifest_paths:
+        with open(manifest_path, encoding='utf8') as f:
+            manifests.append(json.load(f))
+    if not manifests:
+        raise ValueError("No shard manifests found")
+    if any(manifest['shard'] is None for manifest in manifests):
+        raise ValueError("Only manifests of --shard runs can be merged")
+
+    first = manifests[0]
+    shard_count = first['shard'][1]
+    for manifest in manifests:
+        if manifest['shard'][1] != shard_count:
+            raise ValueError(f"Manifests are from runs with different shard counts ({shard_count} and {manifest['shard'][1]})")
+        if manifest['posts_json_sha1'] != first['posts_json_sha1']:
+            raise ValueError("Manifests are from different versions of posts.json")
+        if manifest['settings'] != first['settings']:
+            raise ValueError("Manifests are from runs with different settings")
+
+    shard_indexes = sorted(manifest['shard'][0] for manifest in manifests)
+    if shard_indexes != list(range(shard_count)):
+        missing = sorted(set(range(shard_count)) - set(shard_indexes))
+        duplicate = sorted({index for index in shard_indexes if shard_indexes.count(index) > 1})
+        raise ValueError(f"Shards do not add up: missing {missing or 'none'}, duplicate {duplicate or 'none'}")
+
+    entries = sum(manifest['entries'] for manifest in manifests)
+    if entries != first['entries_total']:
+        raise ValueError(f"Shards cover {entries} of {first['entries_total']} posts.json entries")
+
+    counters = new_counters()
+    posts = []
+    key_shards = {}
+    seen_outputs = set()
+    for manifest in manifests:
+        add_counters(counters, manifest['counters'])
+        for record in manifest['posts']:
+            # Entries with the same key are sharded together, so a key may repeat within one shard
+            if key_shards.setdefault(record['key'], manifest['shard'][0]) != manifest['shard'][0]:
+                raise ValueError(f"Post {record['key']} appears in more than one shard")
+            for output in record['outputs'].values():
+                if output in seen_outputs:
+                    raise ValueError(f"Output {output} was written by more than one shard")
+                seen_outputs.add(output)
+            posts.append(record)
+
+    return {
+        'export': first['export'],
+        'posts_json_sha1': first['posts_json_sha1'],
+        'shard': None,
+        'merged_shards': shard_count,
+        'entries': entries,
+        'entries_total': first['entries_total'],
+        'settings': first['settings'],
+        'counters': counters,
+        'encoding': summarize_encoding(posts),
+        'quarantine': get_quarantine(posts),
+        'posts': sorted(posts, key=lambda record: record['index']),
+    }
+
+# Functions to verify the outputs of an earlier run against posts.json and its manifest
+def get_expected_roles(post, settings):
+    """Return the output roles a post should have after a run with these settings"""
+    if post['front_type'] == 'unknown' or post['back_type'] == 'unknown':
+        return []
+    roles = ['front', 'back']
+    if post['has_bts']:
+        roles.append('bts')
+    images = [role for role, file_type in [('front', post['front_type']), ('back', post['back_type'])] if file_type == 'image']
+    if settings['create_combined_images'] == 'yes':
+        if post['front_type'] == 'image' and post['back_type'] == 'image':
+            roles.append('combined')
+            images.append('combined')
+        if post['has_bts']:
+            roles.append('bts_combined')
+    for role in images:
+        roles += [f"{role}@{rendition['name']}" for rendition in settings['renditions']]
+    return roles
+
+def verify_export(paths, workers):
+    """Check that every post of posts.json has all of its outputs and that they are intact; returns the problems and the entries to redo"""
+    import verify_outputs
+
+    data = load_posts(paths['json_path'])
+    manifest_path = paths['output_root'] / get_manifest_filename(None)
+    try:
+        with open(manifest_path, encoding='utf8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        if list(paths['output_root'].glob('manifest-shard-*-of-*.json')):
+            raise ValueError(f"No {manifest_path.name} in {paths['output_root']}, merge the shard manifests first")
+        manifest = {'settings': DEFAULT_SETTINGS, 'posts': []}
+    settings = validate_settings(manifest['settings'])
+    records = {record['key']: record for record in manifest['posts']}
+    folder_index = index_export(paths)
+
+    result = {'problems': [], 'redo': [], 'files': 0}
+    archive_indexes = {}
+    checks = []
+    for entry in data:
+        try:
+            post = resolve_entry(entry, paths, folder_index, settings)
+        except Exception:
+            continue  # Invalid entries are never processed
+        key = get_post_key(entry)
+        if post['front_path'].name not in folder_index[post['folder_key']]:
+            result['problems'].append((key, None, "input files are missing, the post cannot be processed"))
+            continue
+        record = records.get(key)
+        if record is None:
+            result['problems'].append((key, None, "post was not processed" + ("" if manifest['posts'] else f" (no {manifest_path.name})")))
+            result['redo'].append(entry)
+            continue
+        if 'duplicate_of' in record and settings['dedupe_action'] == 'skip':
+            continue
+        # Linked outputs are the files of the post this one duplicates, with its roles and dates
+        linked = 'duplicate_of' in record
+        expected_roles = record['duplicate_of'].get('roles', []) if linked else get_expected_roles(post, settings)
+
+        missing = [role for role in expected_roles if role not in record['outputs']]
+        for role in missing:
+            result['problems'].append((key, role, "output is missing from the manifest"))
+        if missing:
+            result['redo'].append(entry)
+
+        for role, output in record['outputs'].items():
+            check = {
+                'expected_bytes': record.get('output_info', {}).get(role, {}).get('bytes'),
+                'expected_datetime': None if linked or role.startswith('bts') else post['taken_at'].strftime("%Y:%m:%d %H:%M:%S"),
+            }
+            if record.get('archive'):
+                archive_path = paths['output_root'] / record['archive']
+                if archive_path not in archive_indexes:
+                    try:
+                        with open(archive_path.with_name(archive_path.name + '.index.json'), encoding='utf8') as f:
+                            archive_indexes[archive_path] = json.load(f)['members']
+                    except FileNotFoundError:
+                        archive_indexes[archive_path] = {}
+                member = archive_indexes[archive_path].get(output)
+                if member is None:
+                    result['problems'].append((key, role, f"{output} is not in the index of {record['archive']}"))
+                    continue
+                check.update({'path': archive_path, 'offset': member['offset'], 'size': member['size']})
+                name = f"{record['archive']}#{output}"
+            else:
+                check['path'] = paths['output_root'] / output
+                name = output
+            checks.append((key, role, name, entry, check))
+
+    # Check and hash all files in parallel
+    checksums_path = paths['output_root'] / 'checksums.sha256'
+    previous_checksums = {}
+    if checksums_path.exists():
+        for line in checksums_path.read_text(encoding='utf8').splitlines():
+            checksum, name = line.split('  ', 1)
+            previous_checksums[name] = checksum
+
+    checksums = {}
+    redo_keys = {get_post_key(entry) for entry in result['redo']}
+    file_results = verify_outputs.verify_files([check for _, _, _, _, check in checks], workers)
+    for (key, role, name, entry, _), file_result in zip(checks, file_results):
+        problems = file_result['problems']
+        if file_result['sha256']:
+            if previous_checksums.get(name, file_result['sha256']) != file_result['sha256']:
+                problems.append("contents changed since the last --verify")
+            checksums[name] = file_result['sha256']
+        for problem in problems:
+            result['problems'].append((key, role, f"{name}: {problem}"))
+        if problems and key not in redo_keys:
+            redo_keys.add(key)
+            result['redo'].append(entry)
+    result['files'] = len(checks)
+
+    # A changed file keeps its first checksum, so it is reported until it is processed again
+    checksums.update({name: checksum for name, checksum in previous_checksums.items() if name in checksums})
+    checksums_path.write_text(''.join(f"{checksum}  {name}\n" for name, checksum in sorted(checksums.items())), encoding='utf8')
+    return result
+
+# Functions for the timelapse of all combined images of an export. The frames are combined
+# in memory and piped into a single ffmpeg process as raw RGB, no image file is written.
+TIMELAPSE_FILENAME = 'timelapse.mp4'
+TIMELAPSE_DEFAULT_SIZE = (1080, 1440)
+
+def parse_frame_size(value):
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got '{value}'")
+    if width <= 0 or height <= 0 or width % 2 or height % 2:
+        raise argparse.ArgumentTypeError("width and height must be positive and even")
+    return width, height
+
+def render_timelapse_frame(post, size, text_mode, font_path=''):
+    """Return the combined image of a post fitted into size, with its text overlay, as raw RGB bytes"""
+    from PIL import Image, ImageOps
+
+    with open_image(post['front_path']) as front_image, open_image(post['back_path']) as back_image:
+        combined_image = combine_images_with_resizing(front_image, back_image)
+    frame = ImageOps.pad(combined_image, size, Image.Resampling.LANCZOS, color=(0, 0, 0))
+    # Drawn on the frame rather than the combined image, so the text has the same size in every frame
+    if text_mode != 'no':
+        add_text_overlay(frame, post['taken_at'], post['caption'], text_mode, font_path)
+    return frame.tobytes()
+
+def make_timelapse(paths, settings, output_path, size=TIMELAPSE_DEFAULT_SIZE, fps=10, dates=False, workers=1):
+    """Encode the combined images of all posts in takenAt order into one video; returns the number of frames"""
+    set_image_limits(settings)
+    folder_index = index_export(paths)
+    posts = []
+    for entry in load_posts(paths['json_path']):
+        try:
+            post = resolve_entry(entry, paths, folder_index, settings)
+        except Exception as e:
+            logging.error(f"Skipping invalid entry {entry}: {e}")
+            continue
+        if post['front_type'] == 'image' and post['back_type'] == 'image':
+            posts.append(post)
+    posts.sort(key=lambda post: post['taken_at'])
+    if not posts:
+        raise ValueError("No posts with front and back images")
+
+    # --timelapse-dates adds the date to the text overlay of the settings
+    text_mode = settings['text_overlay']
+    if dates:
+        text_mode = {'no': 'date', 'caption': 'both'}.get(text_mode, text_mode)
+
+    encoder = get_encoder(settings)
+    cmd = ['ffmpeg', '-v', 'error',
+           '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f"{size[0]}x{size[1]}", '-r', str(fps), '-i', '-',
+           '-c:v', 'libx264', '-crf', str(settings['video_crf']), '-preset', encoder['video_preset'],
+           '-pix_fmt', 'yuv420p', '-movflags', '+faststart', '-y', str(output_path)]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    frames = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for post in posts + [None]:
+                if post is not None:
+                    pending.append((post, executor.submit(render_timelapse_frame, post, size, text_mode, settings['overlay_font'])))
+                # Write the oldest frame once enough are rendering, or all of them at the end. At most
+                # two frames per thread are ahead of ffmpeg, so memory stays bounded
+                while pending and (post is None or len(pending) > 2 * workers):
+                    frame_post, future = pending.popleft()
+                    try:
+                        frame = future.result()
+                    except Exception as e:
+                        logging.error(f"Skipping {frame_post['front_path'].name} in the timelapse: {e}")
+                        continue
+                    process.stdin.write(frame)
+                    frames += 1
+        process.stdin.close()
+    except BrokenPipeError:
+        pass  # ffmpeg quit, its error is reported below
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        returncode = process.wait()
+    if returncode != 0:
+        raise OSError(f"ffmpeg failed to encode the timelapse: {process.stderr.read().decode('utf-8', 'replace').strip()}")
+    return frames
+
+_phash_indexes = {}
+
+def get_phash_index(index_path):
+    """Return the perceptual-hash index at index_path, loaded once per process and again when the file changed"""
+    import phash_index
+
+    try:
+        mtime = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    cached = _phash_indexes.get(index_path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, phash_index.load_index(index_path))
+        _phash_indexes[index_path] = cached
+    return cached[1]
+
+def save_phash_index(index_path):
+    import phash_index
+
+    if index_path in _phash_indexes:
+        phash_index.save_index(_phash_indexes[index_path][1], index_path)
+        _phash_indexes[index_path] = (os.stat(index_path).st_mtime_ns, _phash_indexes[index_path][1])
+        logging.info(f"Perceptual-hash index saved: {index_path}")
+
+def open_image(path):
+    """Decode an input image; raises PoisonInput for images that are too large, broken or not images at all"""
+    from PIL import Image
 
+    try:
+        image = Image.open(path)
+        image.load()
+    except FileNotFoundError:
+        raise
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning, OSError, SyntaxError) as e:
+        raise PoisonInput(path, 'decode', str(e))
+    return image
+
+def get_post_phash(front_image, back_image):
+    import phash_index
+
+    return [format(phash_index.dhash(front_image), '016x'), format(phash_index.dhash(back_image), '016x')]
+
+def find_near_duplicate(index, export, record, max_distance, link=False):
+    """Return the index entry of an earlier post whose front and back both look like this post's, or None"""
+    import phash_index
+
+    front_hash, back_hash = (int(value, 16) for value in record['phash'])
+    for _, _, payload in index.find(front_hash, max_distance):
+        if payload['export'] == export and payload['key'] == record['key']:
+            continue  # The same post, from an earlier run
+        # Nothing to link to when the outputs are gone or were never indexed
+        if link and not (payload['outputs'] and all(Path(output).exists() for output in payload['outputs'].values())):
+            continue
+        if phash_index.hamming(back_hash, int(payload['back'], 16)) <= max_distance:
+            return payload
+    return None
+
+def link_file(source, target):
+    """Replace target with a hard link to source, or a symbolic link across file systems"""
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        os.symlink(source, target)
+
+def link_near_duplicate(post, record, duplicate, paths, settings):
+    """Create the outputs of a near-duplicate post as links to the outputs of the post it duplicates"""
+    # Only the outputs this run would create itself, their folders exist
+    roles = ['front', 'back'] + (['combined'] if settings['create_combined_images'] == 'yes' else [])
+    roles += [f"{role}@{rendition['name']}" for role in list(roles) for rendition in settings['renditions']]
+    # Recorded before linking, so --verify finds the outputs that could not be linked
+    record['duplicate_of']['roles'] = [role for role in roles if role in duplicate['outputs']]
+
+    for role, source_path, folder in [('front', post['front_path'], paths['output_folder']),
+                                      ('back', post['back_path'], paths['output_folder']),
+                                      ('combined', None, paths['output_folder_combined'])]:
+        if role not in record['duplicate_of']['roles']:
+            continue
+        original = Path(duplicate['outputs'][role])
+        if role == 'combined':
+            if 'front' not in record['outputs']:
+                continue
+            new_path = folder / get_combined_filenames(front_name, base_front_filename)[0]
+        else:
+            # Keep the extension of the linked file, it has the same contents
+            new_filename = Path(get_output_filename(post['taken_at'], role, source_path, settings)).stem + original.suffix
+            new_path = get_post_output_path(post, role, folder / new_filename)
+            if role == 'front':
+                front_name, base_front_filename = new_path.name, new_filename
+        link_file(original, new_path)
+        record['outputs'][role] = get_manifest_path(new_path, paths)
+        record['output_info'][role] = describe_output(new_path)
+
+        # The renditions of the output, in the folders next to it
+        for rendition_role, rendition_output in duplicate['outputs'].items():
+            if rendition_role.startswith(f"{role}@") and rendition_role in record['duplicate_of']['roles']:
+                rendition_original = Path(rendition_output)
+                rendition_path = new_path.parent / rendition_role.split('@')[1] / f"{new_path.stem}{rendition_original.suffix}"
+                link_file(rendition_original, rendition_path)
+                record['outputs'][rendition_role] = get_manifest_path(rendition_path, paths)
+                record['output_info'][rendition_role] = describe_output(rendition_path)
+
+def register_phash(state, record, counters, settings):
+    """Add a processed post to the perceptual-hash index, unless it duplicates a post that is already in it"""
+    if settings['dedupe'] != 'near' or 'phash' not in record or 'duplicate_of' in record:
+        return
+    # A worker only saw the index as it was when it started, so a near-duplicate of a post
+    # processed at the same time is found here, and its outputs are removed or linked
+    paths = state['paths']
+    export = paths['export']
+    index = get_phash_index(paths['phash_index'])
+    duplicate = find_near_duplicate(index, export, record, int(settings['dedupe_distance']), settings['dedupe_action'] == 'link')
+    if duplicate is None:
+        # Index the post once, even when the export is processed again
+        front_hash = int(record['phash'][0], 16)
+        if not any(payload['export'] == export and payload['key'] == record['key'] for _, _, payload in index.find(front_hash, 0)):
+            # Absolute, so links made from another working directory point at the right files. Outputs
+            # of an archive run only exist in the archive, so there is nothing to link to
+            outputs = {} if 'archive' in state else {role: str((paths['files_root'] / output).resolve())
+                                                     for role, output in record['outputs'].items()}
+            index.add(front_hash, {'export': export, 'key': record['key'], 'back': record['phash'][1], 'outputs': outputs})
+            state['phash_changed'] = True
+        return
+
+    logging.info(f"Near-duplicate of {duplicate['key']} ({duplicate['export']}): {record['key']}")
+    record['duplicate_of'] = {'export': duplicate['export'], 'key': duplicate['key']}
+    if settings['dedupe_action'] == 'link':
+        record['duplicate_of']['roles'] = [role for role in record['outputs'] if role in duplicate['outputs']]
+    counters['duplicates'] += 1
+    for role, output in list(record['outputs'].items()):
+        output_path = paths['files_root'] / output
+        output_path.unlink(missing_ok=True)
+        del record['outputs'][role]
+        record['output_info'].pop(role, None)
+        if settings['dedupe_action'] == 'link' and role in duplicate['outputs']:
+            original = Path(duplicate['outputs'][role])
+            new_path = output_path.with_suffix(original.suffix)
+            if new_path != output_path:
+                new_path = get_unique_filename(new_path)
+            link_file(original, new_path)
+            record['outputs'][role] = get_manifest_path(new_path, paths)
+            record['output_info'][role] = describe_output(new_path)
+
+# Functions to keep a single bad input from stalling a run: stage timeouts, a watchdog per
+# post and limits for decompression bombs. Inputs that trip them are quarantined, listed in
+# the manifest, and the run goes on with the next post.
+PIL_MAX_IMAGE_PIXELS = 1024 * 1024 * 1024 // 4 // 3  # Pillow's default
+
+class PoisonInput(Exception):
+    """An input that cannot be processed: too large to decode, broken, or hanging a stage"""
+
+    def __init__(self, path, stage, reason):
+        super().__init__(f"{Path(path).name}: {reason}")
+        self.path = str(path)
+        self.stage = stage
+        self.reason = reason
+
+class PostTimeout(BaseException):
+    """Raised by the watchdog; not an Exception, so the single steps cannot swallow it"""
+
+@contextlib.contextmanager
+def watchdog(seconds):
+    """Interrupt the code inside with PostTimeout after seconds"""
+    # SIGALRM only works in the main thread of a process, elsewhere nothing is enforced
+    if not seconds or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def expire(signum, frame):
+        raise PostTimeout(f"took longer than {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+@contextlib.contextmanager
+def acquire_paused(lock):
+    """Acquire lock with the watchdog timer stopped, so waiting for it does not count against the post"""
+    if lock is None:
+        yield
+        return
+    remaining = signal.setitimer(signal.ITIMER_REAL, 0)[0] if hasattr(signal, 'setitimer') else 0
+    try:
+        lock.acquire()
+    finally:
+        if remaining:
+            signal.setitimer(signal.ITIMER_REAL, remaining)
+    try:
+        yield
+    finally:
+        lock.release()
+
+def set_image_limits(settings):
+    """Make Pillow refuse images above max_megapixels, instead of only warning below twice its limit"""
+    from PIL import Image
+
+    megapixels = float(settings['max_megapixels'])
+    Image.MAX_IMAGE_PIXELS = int(megapixels * 1000000) if megapixels else PIL_MAX_IMAGE_PIXELS
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+def get_ffmpeg_timeout(settings):
+    return float(settings['ffmpeg_timeout']) or None
+
+def quarantine(record, counters, path, stage, reason):
+    record.setdefault('quarantine', []).append({'input': str(path), 'stage': stage, 'reason': reason})
+    counters['quarantined'] += 1
+    logging.error(f"Quarantined {path} ({stage}): {reason}")
+
+def get_quarantine(records):
+    """The quarantined inputs of all records, for the manifest"""
+    return [{'key': record['key'], **entry} for record in sorted(records, key=lambda record: record['index'])
+            for entry in record.get('quarantine', [])]
+
+def format_quarantine(entries):
+    return "".join(f"\nQuarantined {entry['input']} ({entry['stage']}): {entry['reason']}" for entry in entries)
+
+# Function to process one post: its singles first, then its combined image/video
+def process_post(post, paths, settings):
+    """Process the files of one resolved post under the watchdog and return its counters and manifest record"""
+    counters = new_counters()
+    record = {
+        'index': post['index'],
+        'key': post['key'],
+        'takenAt': post['entry']['takenAt'],
+        'location': post['location'],
+        'caption': post['caption'],
+        'inputs': {'front': str(post['front_path']), 'back': str(post['back_path'])},
+        'outputs': {},
+        'output_info': {},
+        'encoding': {},
+    }
+    if post['has_bts']:
+        record['inputs']['bts'] = str(post['bts_path'])
+
+    set_image_limits(settings)
+    current = {'stage': 'post', 'input': post['front_path']}
+    try:
+        with watchdog(float(settings['post_timeout'])):
+            process_post_files(post, paths, settings, counters, record, current)
+    except PostTimeout as e:
+        counters['skipped'] += 1
+        quarantine(record, counters, current['input'], current['stage'], str(e))
+    return {'counters': counters, 'record': record}
+
+def process_post_files(post, paths, settings, counters, record, current):
+    """Process the files of a post into its counters and record, keeping the stage and input at hand in current"""
+    output_folder = paths['output_folder']
+    output_folder_combined = paths['output_folder_combined']
+
+    front_path = post['front_path']
+    back_path = post['back_path']
+    bts_path = post['bts_path']
+    front_type = post['front_type']
+    back_type = post['back_type']
+    bts_type = post['bts_type']
+    has_bts = post['has_bts']
+    taken_at = post['taken_at']
+    location = post['location']
+    caption = post['caption']
+
+    try:
         # Skip if files don't exist or front/back are unknown types
         if front_type == 'unknown' or back_type == 'unknown':
-            logging.info(f"Skipping unknown file types: {front_filename}, {back_filename}")
-            skipped_files_count += 1
-            continue
+            logging.info(f"Skipping unknown file types: {front_path.name}, {back_path.name}")
+            counters['skipped'] += 1
+            return
 
-        # Skip bts videos if user chose not to process them or if bts file type is unknown
-        if has_bts and process_videos == 'no':
-            logging.info(f"Skipping behind-the-scenes video (user choice): {bts_filename}")
-            has_bts = False  # Process as regular image combination
-        elif has_bts and bts_type == 'unknown':
-            logging.info(f"Skipping unknown BTS file type: {bts_filename}")
-            has_bts = False
+        if post['bts_skip_reason'] == 'user choice':
+            logging.info(f"Skipping behind-the-scenes video (user choice): {bts_path.name}")
+        elif post['bts_skip_reason']:
+            logging.info(f"Skipping unknown BTS file type: {bts_path.name}")
 
         # Log what we found
         if has_bts:
-            logging.info(f"Found BeReal with BTS video: front={front_filename} ({front_type}), back={back_filename} ({back_type}), bts={bts_filename} ({bts_type})")
-            video_files_count += 1
+            logging.info(f"Found BeReal with BTS video: front={front_path.name} ({front_type}), back={back_path.name} ({back_type}), bts={bts_path.name} ({bts_type})")
+            counters['videos'] += 1
         else:
-            logging.info(f"Found BeReal: front={front_filename} ({front_type}), back={back_filename} ({back_type})")
-
-        taken_at = datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
-        location = entry.get('location')  # This will be None if 'location' is not present
-        caption = entry.get('caption')  # This will be None if 'caption' is not present
+            logging.info(f"Found BeReal: front={front_path.name} ({front_type}), back={back_path.name} ({back_type})")
+
+        # Decode front and back once, for the perceptual hashes, the renditions and the combined image
+        decode = settings['dedupe'] == 'near' or settings['create_combined_images'] == 'yes' or settings['renditions']
+        current.update(stage='decode', input=front_path)
+        front_image = open_image(front_path) if decode and front_type == 'image' else None
+        current.update(stage='decode', input=back_path)
+        back_image = open_image(back_path) if decode and back_type == 'image' else None
+
+        # Look for an earlier post with the same pictures
+        if settings['dedupe'] == 'near' and front_image is not None and back_image is not None:
+            record['phash'] = get_post_phash(front_image, back_image)
+            duplicate = find_near_duplicate(get_phash_index(paths['phash_index']), paths['export'],
+                                            record, int(settings['dedupe_distance']), settings['dedupe_action'] == 'link')
+            if duplicate is not None:
+                logging.info(f"Near-duplicate of {duplicate['key']} ({duplicate['export']}): {post['key']}")
+                record['duplicate_of'] = {'export': duplicate['export'], 'key': duplicate['key']}
+                counters['duplicates'] += 1
+                if settings['dedupe_action'] == 'link':
+                    link_near_duplicate(post, record, duplicate, paths, settings)
+                return
 
         # Process individual files
         processed_front_path = None
@@ -687,41 +2143,32 @@ for entry in data:
         # Process front and back images
         for path, role, file_type in [(front_path, 'front', front_type), (back_path, 'back', back_type)]:
             logging.info(f"Processing {file_type}: {path}")
-            
+            current.update(stage=role, input=path)
+
             if file_type == 'image':
+                # Adjust filename based on user's choice
+                new_filename = get_output_filename(taken_at, role, path, settings)
+                new_path = get_post_output_path(post, role, output_folder / new_filename)
+
                 # Check if format conversion is enabled by the user
-                if convert_format == 'yes':
-                    # Convert image format if necessary
-                    converted_path, converted = convert_image_format(path, target_format, image_quality)
+                converted = False
+                if settings['convert_format'] == 'yes':
+                    # Convert image format if necessary, straight into the output file
+                    try:
+                        converted_path, converted, encoding = convert_image_format(path, settings['target_format'], settings['image_quality'], new_path,
+                                                                                   get_encoder(settings), front_image if role == 'front' else back_image)
+                    except PoisonInput:
+                        new_path.unlink(missing_ok=True)
+                        raise
                     if converted_path is None:
-                        skipped_files_count += 1
+                        new_path.unlink(missing_ok=True)
+                        counters['skipped'] += 1
                         continue  # Skip this file if conversion failed
                     if converted:
-                        converted_files_count += 1
-                    path = converted_path  # Update path for further processing
-
-                # Get original file extension
-                file_extension = path.suffix.lower()
-
-                # Adjust filename based on user's choice
-                time_str = taken_at.strftime("%Y-%m-%dT%H-%M-%S")
-                original_filename_without_extension = Path(path).stem
-
-                # Determine the actual file extension based on conversion
-                actual_extension = file_extension
-                if convert_format == 'yes':
-                    actual_extension = f'.{target_format}'
-
-                if keep_original_filename == 'yes':
-                    new_filename = f"{time_str}_{role}_{original_filename_without_extension}{actual_extension}"
-                else:
-                    new_filename = f"{time_str}_{role}{actual_extension}"
-
-                new_path = output_folder / new_filename
-                new_path = get_unique_filename(new_path)
+                        counters['converted'] += 1
+                        record['encoding'][role] = encoding
 
-                if convert_format == 'yes' and converted:
-                    converted_path.rename(new_path)
+                if converted:
                     update_exif(new_path, taken_at, location, caption)
                     logging.info(f"EXIF data added to converted image.")
                     image_path_str = str(new_path)
@@ -733,124 +2180,1061 @@ for entry in data:
                     image_path_str = str(new_path)
                     update_iptc(image_path_str, caption)
 
+            record['outputs'][role] = get_manifest_path(new_path, paths)
+            record['output_info'][role] = describe_output(new_path)
+            if file_type == 'image' and settings['renditions']:
+                counters['renditions'] += save_renditions(front_image if role == 'front' else back_image, new_path, role, record, paths, settings)
+
             # Store processed paths for combination
             if role == 'front':
                 processed_front_path = new_path
+                combined_filename, bts_combined_filename = get_combined_filenames(new_path.name, new_filename)
             elif role == 'back':
                 processed_back_path = new_path
 
             logging.info(f"Successfully processed {role} {file_type}.")
-            processed_files_count += 1
+            counters['processed'] += 1
 
         # Process BTS video if present
         if has_bts and bts_path:
             logging.info(f"Processing BTS video: {bts_path}")
-            
-            time_str = taken_at.strftime("%Y-%m-%dT%H-%M-%S")
-            original_filename_without_extension = Path(bts_path).stem
-            file_extension = bts_path.suffix.lower()
-
-            if keep_original_filename == 'yes':
-                new_filename = f"{time_str}_bts_{original_filename_without_extension}{file_extension}"
-            else:
-                new_filename = f"{time_str}_bts{file_extension}"
+            current.update(stage='bts', input=bts_path)
 
-            new_path = output_folder / new_filename
-            new_path = get_unique_filename(new_path)
+            new_filename = get_output_filename(taken_at, 'bts', bts_path, settings)
+            new_path = get_post_output_path(post, 'bts', output_folder / new_filename)
 
             # Copy video file
             shutil.copy2(bts_path, new_path)
-            
+
             # Add metadata to video
-            update_video_metadata(new_path, taken_at, location, caption)
+            try:
+                update_video_metadata(new_path, taken_at, location, caption, get_ffmpeg_timeout(settings))
+            except PoisonInput:
+                new_path.unlink(missing_ok=True)
+                raise
             logging.info(f"BTS video metadata added.")
-            
+
             processed_bts_path = new_path
-            processed_files_count += 1
+            record['outputs']['bts'] = get_manifest_path(new_path, paths)
+            record['output_info']['bts'] = describe_output(new_path)
+            counters['processed'] += 1
             logging.info(f"Successfully processed BTS video.")
 
-        # Store data for combination
-        combination_data = {
-            'front_path': processed_front_path,
-            'back_path': processed_back_path,
-            'bts_path': processed_bts_path,
-            'taken_at': taken_at,
-            'location': location,
-            'caption': caption,
-            'has_bts': has_bts
-        }
-        
-        # Store in primary_images list for combination processing
-        primary_images.append(combination_data)
-
         print("")
+    except PoisonInput as e:
+        quarantine(record, counters, current['input'], e.stage, e.reason)
+        counters['skipped'] += 1
+        return
     except Exception as e:
-        logging.error(f"Error processing entry {entry}: {e}")
-        skipped_files_count += 1
+        logging.error(f"Error processing entry {post['entry']}: {e}")
+        counters['skipped'] += 1
+        return
 
-# Create combined images/videos if user chose 'yes'
-if create_combined_images == 'yes':
-    #Create output folder if it doesn't exist
-    output_folder_combined.mkdir(parents=True, exist_ok=True)
-
-    for i, bereal_data in enumerate(primary_images):
-        # Extract data for this BeReal
-        front_path = bereal_data['front_path']
-        back_path = bereal_data['back_path']
-        bts_path = bereal_data['bts_path']
-        taken_at = bereal_data['taken_at']
-        location = bereal_data['location']
-        caption = bereal_data['caption']
-        has_bts = bereal_data['has_bts']
-
-        timestamp = front_path.stem.split('_')[0]
+    # Create combined images/videos if user chose 'yes'
+    if settings['create_combined_images'] == 'yes' and processed_front_path and processed_back_path:
+        timestamp = processed_front_path.stem.split('_')[0]
+        try:
+            # Always create front + back combination
+            logging.info(f"Creating front + back combination for {timestamp}")
+            current.update(stage='combined', input=front_path)
+            if front_image is not None and back_image is not None:
+                combined_image = combine_images_with_resizing(front_image, back_image)
+            else:
+                combined_image = combine_images_with_resizing(processed_front_path, processed_back_path)
+            if settings['text_overlay'] != 'no':
+                add_text_overlay(combined_image, taken_at, caption, settings['text_overlay'], settings['overlay_font'])
 
-        # Always create front + back combination
-        logging.info(f"Creating front + back combination for {timestamp}")
-        output_format = 'jpg'
-        combined_filename = f"{timestamp}_combined.{output_format}"
-        combined_image = combine_images_with_resizing(front_path, back_path)
+            combined_image_path = output_folder_combined / combined_filename
+            record['encoding']['combined'] = save_encoded_image(combined_image, combined_image_path, 'jpg', settings['image_quality'], get_encoder(settings))
+            counters['combined'] += 1
 
-        combined_image_path = output_folder_combined / combined_filename
-        combined_image.save(combined_image_path, 'JPEG', quality=image_quality)
-        combined_files_count += 1
+            logging.info(f"Combined image saved: {combined_image_path} with quality {record['encoding']['combined']['quality']}")
 
-        logging.info(f"Combined image saved: {combined_image_path} with quality {image_quality}")
+            # Add metadata to combined image
+            update_exif(combined_image_path, taken_at, location, caption)
+            logging.info(f"Metadata added to combined image.")
 
-        # Add metadata to combined image
-        update_exif(combined_image_path, taken_at, location, caption)
-        logging.info(f"Metadata added to combined image.")
+            image_path_str = str(combined_image_path)
+            update_iptc(image_path_str, caption)
 
-        image_path_str = str(combined_image_path)
-        update_iptc(image_path_str, caption)
+            record['outputs']['combined'] = get_manifest_path(combined_image_path, paths)
+            record['output_info']['combined'] = describe_output(combined_image_path)
+            if settings['renditions']:
+                counters['renditions'] += save_renditions(combined_image, combined_image_path, 'combined', record, paths, settings)
+        except Exception as e:
+            logging.error(f"Error creating combined image for {timestamp}: {e}")
 
         # If BTS video exists, create front + BTS video combination
-        if has_bts and bts_path:
+        if has_bts and processed_bts_path and ffmpeg_available():
             logging.info(f"Creating BTS video + front overlay combination for {timestamp}")
-            output_format = 'mp4'
-            bts_combined_filename = f"{timestamp}_bts_combined.{output_format}"
             bts_combined_video_path = output_folder_combined / bts_combined_filename
 
             # BTS video (back camera) as background, front camera image (selfie) as overlay
-            # success = combine_video_with_image(bts_path, front_path, bts_combined_video_path, video_crf)
-            success = combine_video_with_image(bts_path, back_path, bts_combined_video_path, video_crf)
-            if success:
-                combined_files_count += 1
-                logging.info(f"Combined BTS video saved: {bts_combined_video_path}")
-                
-                # Add metadata to combined video
-                update_video_metadata(bts_combined_video_path, taken_at, location, caption)
-                logging.info(f"Metadata added to combined BTS video.")
-            else:
-                logging.error(f"Failed to create combined BTS video for {timestamp}")
+            # success = combine_video_with_image(processed_bts_path, processed_front_path, bts_combined_video_path, video_crf)
+            current.update(stage='bts_combined', input=bts_path)
+            encoder = get_encoder(settings)
+            try:
+                with acquire_paused(_video_slots):
+                    start_time = time.perf_counter()
+                    success = combine_video_with_image(processed_bts_path, processed_back_path, bts_combined_video_path, settings['video_crf'],
+                                                       encoder['video_preset'], encoder['video_tune'], int(encoder['video_threads']),
+                                                       get_ffmpeg_timeout(settings))
+                if success:
+                    counters['combined'] += 1
+                    record['encoding']['bts_combined'] = {'bytes': bts_combined_video_path.stat().st_size,
+                                                          'seconds': round(time.perf_counter() - start_time, 4)}
+                    logging.info(f"Combined BTS video saved: {bts_combined_video_path}")
+
+                    # Add metadata to combined video
+                    update_video_metadata(bts_combined_video_path, taken_at, location, caption, get_ffmpeg_timeout(settings))
+                    logging.info(f"Metadata added to combined BTS video.")
+
+                    record['outputs']['bts_combined'] = get_manifest_path(bts_combined_video_path, paths)
+                    record['output_info']['bts_combined'] = describe_output(bts_combined_video_path)
+                else:
+                    logging.error(f"Failed to create combined BTS video for {timestamp}")
+            except PoisonInput as e:
+                bts_combined_video_path.unlink(missing_ok=True)
+                quarantine(record, counters, current['input'], e.stage, e.reason)
 
         print("")
 
-# Clean up backup files
-print(STYLING['BOLD'] + "Removing backup files left behind by iptcinfo3" + STYLING["RESET"])
-remove_backup_files(output_folder)
-if create_combined_images == 'yes': remove_backup_files(output_folder_combined)
-print("")
+def format_counters(counters):
+    summary = f"Total files processed: {counters['processed']}\nFiles converted: {counters['converted']}\nVideo files processed: {counters['videos']}\nFiles skipped: {counters['skipped']}\nFiles combined: {counters['combined']}"
+    if counters.get('renditions'):
+        summary += f"\nRenditions created: {counters['renditions']}"
+    if counters.get('duplicates'):
+        summary += f"\nNear-duplicates: {counters['duplicates']}"
+    if counters.get('quarantined'):
+        summary += f"\nInputs quarantined: {counters['quarantined']}"
+    return summary
+
+# Functions for the encoder report: bytes written against time spent encoding
+def summarize_encoding(records):
+    report = {'images': 0, 'image_bytes': 0, 'image_seconds': 0.0, 'videos': 0, 'video_bytes': 0, 'video_seconds': 0.0,
+              'compared': 0, 'compared_bytes': 0, 'compared_seconds': 0.0, 'baseline_bytes': 0, 'baseline_seconds': 0.0}
+    for record in records:
+        for stats in record.get('encoding', {}).values():
+            kind = 'image' if 'quality' in stats else 'video'
+            report[f"{kind}s"] += 1
+            report[f"{kind}_bytes"] += stats['bytes']
+            report[f"{kind}_seconds"] += stats['seconds']
+            if 'baseline_bytes' in stats:
+                report['compared'] += 1
+                report['compared_bytes'] += stats['bytes']
+                report['compared_seconds'] += stats['seconds']
+                report['baseline_bytes'] += stats['baseline_bytes']
+                report['baseline_seconds'] += stats['baseline_seconds']
+    for key in report:
+        if key.endswith('seconds'):
+            report[key] = round(report[key], 3)
+    return report
+
+def format_encoding_report(report):
+    summary = (f"Encoded {report['images']} images ({format_bytes(report['image_bytes'])}) in {report['image_seconds']:.1f}s"
+               f" and {report['videos']} videos ({format_bytes(report['video_bytes'])}) in {report['video_seconds']:.1f}s")
+    if report['compared']:
+        saved = report['baseline_bytes'] - report['compared_bytes']
+        extra_seconds = report['compared_seconds'] - report['baseline_seconds']
+        summary += (f"\nCompared with the default encoder: {format_bytes(abs(saved))} {'saved' if saved >= 0 else 'more'}"
+                    f" ({saved / max(report['baseline_bytes'], 1):.1%}) for {extra_seconds:+.2f}s of encode time")
+        if saved > 0 and extra_seconds > 0:
+            summary += f" ({extra_seconds * 1000 / (saved / 1024 / 1024):.0f} ms per MB saved)"
+    return summary
+
+def add_counters(total, counters):
+    for key, value in counters.items():
+        total[key] += value
+
+# Function to load an export and resolve all of its posts
+def prepare_export(export_path, settings, output_root=None, shard=None, data=None, archive=None):
+    """Return the state of one export (only the given shard or data entries, staged for an archive if given)"""
+    paths = get_export_paths(export_path, output_root)
+    posts_subset = data is not None
+    if data is None:
+        data = load_posts(paths['json_path'])
+        posts_json_sha1 = hashlib.sha1(paths['json_path'].read_bytes()).hexdigest()
+    else:
+        posts_json_sha1 = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    folder_index = index_export(paths)
+
+    state = {
+        'name': Path(export_path).name,
+        'paths': paths,
+        'posts': [],
+        'records': [],
+        'counters': new_counters(),
+        'number_of_files': count_files_in_folder(paths['photo_folder']) + count_files_in_folder(paths['bereal_folder']),
+        'posts_json_sha1': posts_json_sha1,
+        'shard': shard,
+        'entries': 0,
+        'entries_total': len(data),
+        'posts_subset': posts_subset,
+    }
+    # Posts given as data keep their position in posts.json, which orders the manifest
+    positions = {}
+    all_data = []
+    if posts_subset and paths['json_path'].exists():
+        all_data = load_posts(paths['json_path'])
+        for position, entry in enumerate(all_data):
+            try:
+                positions.setdefault(get_post_key(entry), []).append(position)
+            except (KeyError, TypeError):
+                pass
+    in_posts_json = bool(all_data)
+    posts = []
+    for index, entry in enumerate(data):
+        in_shard = shard is None or get_shard(entry, shard[1]) == shard[0]
+        state['entries'] += in_shard
+        try:
+            post = resolve_entry(entry, paths, folder_index, settings)
+            post['entry'] = entry
+            post['key'] = get_post_key(entry)
+            in_posts_json = in_posts_json and bool(positions.get(post['key']))
+            post['index'] = positions[post['key']].pop(0) if positions.get(post['key']) else index
+            post['in_shard'] = in_shard
+            posts.append(post)
+        except Exception as e:
+            if in_shard:
+                logging.error(f"Error processing entry {entry}: {e}")
+                state['counters']['skipped'] += 1
+
+    # A subset taken from the export's own posts.json (redo-posts.json, or posts added to a
+    # watched export) describes the current posts.json in the manifest
+    state['subset_of_posts_json'] = in_posts_json
+    if in_posts_json:
+        state['posts_json_sha1'] = hashlib.sha1(paths['json_path'].read_bytes()).hexdigest()
+        state['entries'] = sum(shard is None or get_shard(entry, shard[1]) == shard[0] for entry in all_data)
+        state['entries_total'] = len(all_data)
+
+    # Named up front, so the singles of posts taken in the same second, processed at the same
+    # time, keep matching suffixes. Shards cannot see each other's outputs, so they derive the
+    # names from posts.json alone, which every shard reads in full.
+    taken = set(folder_index['output_folder']) if shard is None and not archive else set()
+    assign_output_names(posts, settings, taken)
+    state['posts'] = [post for post in posts if post['in_shard']]
+    if posts_subset:
+        reuse_output_names(state['posts'], paths['output_root'] / get_manifest_filename(shard), paths, settings)
+
+    if archive:
+        if settings['dedupe'] == 'near' and settings['dedupe_action'] == 'link':
+            raise ValueError("Outputs written to an archive cannot be linked, use the 'skip' dedupe action")
+        paths['output_root'].mkdir(parents=True, exist_ok=True)
+        staging_root = Path(tempfile.mkdtemp(prefix='bereal-staging-'))
+        paths['files_root'] = staging_root
+        paths['output_folder'] = staging_root / '__processed'
+        paths['output_folder_combined'] = staging_root / '__combined'
+        state['archive'] = {'format': archive['format'], 'max_bytes': archive['max_bytes'], 'number': 0, 'file': None}
+
+    paths['output_folder'].mkdir(parents=True, exist_ok=True)  # Create the output folder if it doesn't exist
+    if settings['create_combined_images'] == 'yes':
+        paths['output_folder_combined'].mkdir(parents=True, exist_ok=True)
+    for rendition in settings['renditions']:
+        (paths['output_folder'] / rendition['name']).mkdir(exist_ok=True)
+        if settings['create_combined_images'] == 'yes':
+            (paths['output_folder_combined'] / rendition['name']).mkdir(exist_ok=True)
+    return state
+
+def finish_export(state, settings):
+    paths = state['paths']
+    counters = state['counters']
+
+    # Clean up backup files
+    print(STYLING['BOLD'] + "Removing backup files left behind by iptcinfo3" + STYLING["RESET"])
+    remove_backup_files(paths['output_folder'])
+    if settings['create_combined_images'] == 'yes': remove_backup_files(paths['output_folder_combined'])
+    print("")
+
+    if 'archive' in state:
+        close_archive(state)
+        shutil.rmtree(paths['files_root'], ignore_errors=True)
+    if state.get('phash_changed'):
+        save_phash_index(paths['phash_index'])
+    manifest = write_manifest(state, settings)
+    # Shards only cover part of the export, their catalog is written when the manifests are merged
+    if state['shard'] is None:
+        update_catalog(manifest, paths['output_root'], state.get('catalog_path'))
+
+    # Summary
+    logging.info(f"Finished processing {state['name']}.\nNumber of input-files: {state['number_of_files']}\n{format_counters(counters)}\n"
+                 f"{format_encoding_report(manifest['encoding'])}{format_quarantine(manifest['quarantine'])}")
+
+# Functions for the memory budget: the peak memory of a post is estimated from its image
+# sizes and the work the settings ask for, and the scheduler only runs as many posts at
+# once as fit into the budget.
+BEREAL_IMAGE_SIZE = (1500, 2000)  # Assumed when an image header cannot be read
+BTS_VIDEO_SIZE = (1080, 1920)  # Videos are not probed, BTS videos are at most this large
+POST_OVERHEAD_BYTES = 32 * 1024 * 1024  # Python objects, decoder and encoder state of one post
+# Frames x264 looks ahead with each preset (rc-lookahead); references and frame threads come on top
+X264_LOOKAHEAD_FRAMES = {'ultrafast': 0, 'superfast': 0, 'veryfast': 10, 'faster': 20, 'fast': 30,
+                         'medium': 40, 'slow': 50, 'slower': 60, 'veryslow': 60}
+X264_EXTRA_FRAMES = 16
+
+def get_image_size(path):
+    from PIL import Image
 
-# Summary
-logging.info(f"Finished processing.\nNumber of input-files: {number_of_files}\nTotal files processed: {processed_files_count}\nFiles converted: {converted_files_count}\nVideo files processed: {video_files_count}\nFiles skipped: {skipped_files_count}\nFiles combined: {combined_files_count}")
+    try:
+        with Image.open(path) as img:  # Only reads the header
+            return img.size
+    except Exception:
+        return BEREAL_IMAGE_SIZE
+
+def estimate_post_memory(post, settings):
+    """Estimate the peak memory of processing one post in bytes"""
+    if post['front_type'] == 'unknown' or post['back_type'] == 'unknown':
+        return POST_OVERHEAD_BYTES
+    # Pillow keeps every pixel of a decoded image in 4 bytes. The decoded images are held for the
+    # whole post when they are reused, plus the largest of the single steps
+    front = 4 * math.prod(get_image_size(post['front_path'])) if post['front_type'] == 'image' else 0
+    back = 4 * math.prod(get_image_size(post['back_path'])) if post['back_type'] == 'image' else 0
+    encoder = get_encoder(settings)
+    # Encoded images are kept in memory, the target size and the report keep a second one
+    encode_copies = 2 if encoder['target_bytes'] or encoder['report'] == 'yes' else 1
+
+    decode = settings['dedupe'] == 'near' or settings['create_combined_images'] == 'yes' or settings['renditions']
+    held = front + back if decode else 0
+    steps = [0]
+    if settings['convert_format'] == 'yes' or settings['renditions']:
+        largest = max(front, back)
+        # Without the decoded images held, every conversion decodes its own copy
+        steps.append(largest // 4 * encode_copies + (0 if decode else largest))
+    if settings['create_combined_images'] == 'yes':
+        # The combined image, the overlay at 1/3.33 of the back image with its alpha mask, and the encode
+        steps.append(front + back // 8 + front // 4 * encode_copies + (0 if decode else front + back))
+        if post['has_bts']:
+            frame = math.prod(BTS_VIDEO_SIZE) * 3  # x264 planes, lowres copies and motion data
+            frames = X264_LOOKAHEAD_FRAMES.get(encoder['video_preset'], 40) + X264_EXTRA_FRAMES
+            steps.append(frame * frames)
+    return POST_OVERHEAD_BYTES + held + max(steps)
+
+# Limits how many videos the worker processes encode at the same time, see choose_video_encoding
+_video_slots = None
+
+# Function to load the heavy libraries once per worker process instead of once per export
+def init_worker(video_slots=None):
+    global _video_slots
+    _video_slots = video_slots
+    from PIL import Image, ImageDraw  # noqa: F401
+    import piexif  # noqa: F401
+    from iptcinfo3 import IPTCInfo  # noqa: F401
+    import ffmpeg  # noqa: F401
+
+# Function to set the video preset and threads of a run from the video calibration
+def apply_video_calibration(states, settings, workers, args):
+    """Choose the video encoding for the BTS videos of all exports and return how many may run at once"""
+    try:
+        calibration = load_video_calibration(args.video_calibration)
+    except (OSError, ValueError, KeyError) as e:
+        raise ValueError(f"Cannot load the video calibration ({e}), run with --calibrate-video first")
+    total_frames = sum(get_video_frames(post['bts_path']) for state in states for post in state['posts'] if post['has_bts'])
+    if not total_frames:
+        logging.info("No BTS videos to encode, the video calibration is not used")
+        return None
+
+    choice = choose_video_encoding(calibration, total_frames, workers, args.video_fps, args.video_budget)
+    # Not part of the settings proper, it depends on the machine: the manifest lists it on its own,
+    # so the manifests of shards run on different machines can still be merged
+    settings['video_encoding'] = {'video_preset': choice['preset'], 'video_threads': choice['threads']}
+    logging.info(f"Encoding {total_frames} video frames with preset {choice['preset']}, {choice['jobs']} videos at once "
+                 f"with {choice['threads']} threads each: {choice['total_fps']:.1f} fps for {choice['required_fps']:.1f} required, "
+                 f"about {choice['estimated_seconds']:.0f}s")
+    return choice['jobs']
+
+# Function to run the posts of one or more exports, round-robin on one shared worker pool
+def run_exports(states, settings, workers=1, pool=None, progress=None, memory_budget=None, video_jobs=None):
+    """Process all posts of all exports, keeping the estimated memory of running posts within memory_budget"""
+    def handle_result(state, result):
+        register_phash(state, result['record'], result['counters'], settings)
+        result['record']['counters'] = result['counters']  # So a later run over some posts can replace them
+        if 'archive' in state:
+            archive_outputs(state, result['record'])
+        add_counters(state['counters'], result['counters'])
+        state['records'].append(result['record'])
+        if progress:
+            progress({'event': 'post', 'export': state['name'], 'key': result['record']['key'],
+                      'outputs': result['record']['outputs'], 'counters': result['counters']})
+
+    def handle_finished(state):
+        finish_export(state, settings)
+        if progress:
+            progress({'event': 'export_finished', 'export': state['name'], 'counters': state['counters']})
+
+    if pool is None and workers <= 1:
+        for state in states:
+            for post in state['posts']:
+                handle_result(state, process_post(post, state['paths'], settings))
+            handle_finished(state)
+        return
+
+    if pool is None:
+        video_slots = multiprocessing.Semaphore(video_jobs) if video_jobs else None
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(video_slots,)) as pool:
+            run_exports(states, settings, workers, pool, progress, memory_budget)
+        return
+
+    for state in states:
+        state['pending'] = iter(state['posts'])
+        state['held_back'] = None
+        state['in_flight'] = 0
+        state['exhausted'] = False
+    rotation = deque(states)
+    max_in_flight = workers * 2
+
+    in_flight = {}
+    reserved = 0
+    peak = {'posts': 0, 'bytes': 0}
+    while rotation or in_flight:
+        # Fill the queue, taking one post from each export in turn
+        while rotation and len(in_flight) < max_in_flight:
+            state = rotation.popleft()
+            post = state['held_back'] or next(state['pending'], None)
+            state['held_back'] = None
+            if post is None:
+                state['exhausted'] = True
+                if state['in_flight'] == 0:
+                    handle_finished(state)
+                continue
+            estimate = 0
+            if memory_budget:
+                estimate = estimate_post_memory(post, settings)
+                # Wait for running posts to free their memory; a post too large for the budget runs alone
+                if in_flight and reserved + estimate > memory_budget:
+                    state['held_back'] = post
+                    rotation.appendleft(state)
+                    break
+                if estimate > memory_budget:
+                    logging.warning(f"Post {post['key']} needs an estimated {format_bytes(estimate)}, "
+                                    f"more than the memory budget, running it alone")
+            future = pool.submit(process_post, post, state['paths'], settings)
+            in_flight[future] = (state, estimate)
+            reserved += estimate
+            peak = {'posts': max(peak['posts'], len(in_flight)), 'bytes': max(peak['bytes'], reserved)}
+            state['in_flight'] += 1
+            rotation.append(state)
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            state, estimate = in_flight.pop(future)
+            reserved -= estimate
+            state['in_flight'] -= 1
+            try:
+                handle_result(state, future.result())
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                logging.error(f"Worker failed while processing a post of {state['name']}: {e}")
+                state['counters']['skipped'] += 1
+            if state['in_flight'] == 0 and state['exhausted']:
+                handle_finished(state)
+
+    if memory_budget:
+        logging.info(f"Memory budget {format_bytes(memory_budget)}: up to {peak['posts']} posts at once, "
+                     f"{format_bytes(peak['bytes'])} estimated at the peak")
+
+# Function to find the exports of a batch
+def find_exports(batch_paths):
+    """Return the export folders among the given paths; a folder without posts.json is searched one level deep"""
+    exports = []
+    for batch_path in batch_paths:
+        batch_path = Path(batch_path)
+        if (batch_path / 'posts.json').exists():
+            exports.append(batch_path)
+        elif batch_path.is_dir():
+            exports.extend(sorted(child for child in batch_path.iterdir() if (child / 'posts.json').exists()))
+        else:
+            logging.error(f"No BeReal export found at {batch_path}")
+    return exports
+
+def get_output_roots(exports, output_root):
+    """Give every export its own output root below output_root, named after the export folder"""
+    if not output_root:
+        return [None] * len(exports)
+    roots = []
+    taken = set()
+    for export_path in exports:
+        roots.append(Path(output_root) / get_unique_name(export_path.name, taken))
+    return roots
+
+# Long-lived worker daemon: keeps one warm worker pool and takes jobs over a Unix socket.
+# The protocol is one JSON object per line. A job looks like
+#   {"exports": ["/path/to/export", ...], "settings": {...}, "output_root": "...", "posts": [...], "catalog": "..."}
+# where everything but "exports" is optional and "posts" replaces the posts.json of a single export.
+# The daemon answers with a stream of events ("accepted", "post", "export_finished") and ends
+# with either "finished" or "error".
+def run_job(job, pool, workers, send, memory_budget=None):
+    """Run one daemon job on the shared pool, sending progress events through send"""
+    settings = validate_settings(job.get('settings', {}))
+    exports = find_exports(job['exports'])
+    if not exports:
+        raise ValueError("No BeReal export found")
+    if job.get('posts') is not None and len(exports) != 1:
+        raise ValueError("A list of posts can only be given for a single export")
+    archive = job.get('archive')
+    if archive and archive.get('format') not in ['tar', 'zip']:
+        raise ValueError("Archive format must be 'tar' or 'zip'")
+
+    states = [prepare_export(export_path, settings, output_root, data=job.get('posts'), archive=archive)
+              for export_path, output_root in zip(exports, get_output_roots(exports, job.get('output_root')))]
+    for state in states:
+        state['catalog_path'] = job.get('catalog')
+        if job.get('phash_index'):
+            state['paths']['phash_index'] = Path(job['phash_index'])
+    send({'event': 'accepted', 'exports': [state['name'] for state in states],
+          'posts': sum(len(state['posts']) for state in states)})
+
+    run_exports(states, settings, workers, pool, progress=send, memory_budget=memory_budget)
+
+    total = new_counters()
+    for state in states:
+        add_counters(total, state['counters'])
+    send({'event': 'finished', 'counters': total})
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        def send(event):
+            self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+        daemon = self.server
+        started = time.perf_counter()
+        try:
+            job = json.loads(self.rfile.readline())
+            run_job(job, daemon.pool, daemon.workers, send, daemon.memory_budget)
+            logging.info(f"Job for {', '.join(job['exports'])} finished in {time.perf_counter() - started:.1f}s")
+        except (BrokenPipeError, ConnectionResetError):
+            logging.warning("Client disconnected before its job finished")
+        except BrokenProcessPool as e:
+            logging.error(f"Worker pool broke while running a job, restarting it: {e}")
+            daemon.restart_pool()
+            send({'event': 'error', 'message': f"Worker pool broke: {e}"})
+        except Exception as e:
+            logging.error(f"Job failed: {e}")
+            send({'event': 'error', 'message': str(e)})
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers, memory_budget=None):
+        self.workers = workers
+        self.memory_budget = memory_budget
+        self.pool_lock = threading.Lock()
+        self.start_pool()
+        super().__init__(socket_path, JobHandler)
+
+    def start_pool(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        # Start all workers (and load their libraries) now instead of on the first job
+        wait([self.pool.submit(time.sleep, 0) for _ in range(self.workers)])
+
+    def restart_pool(self):
+        with self.pool_lock:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.start_pool()
+
+def serve_daemon(socket_path, workers, memory_budget=None):
+    socket_path = Path(socket_path)
+    if socket_path.exists():
+        socket_path.unlink()  # Left behind by a daemon that did not shut down cleanly
+
+    server = JobServer(str(socket_path), workers, memory_budget)
+    # serve_forever() returns once shutdown() is called, which has to happen from another thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logging.info(f"Daemon listening on {socket_path} with {workers} warm workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        server.server_close()
+        server.pool.shutdown(cancel_futures=True)
+        socket_path.unlink(missing_ok=True)
+        logging.info("Daemon stopped")
+
+def submit_job(socket_path, job):
+    """Send a job to a running daemon and print its progress; returns the final event"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        client.sendall((json.dumps(job) + '\n').encode('utf-8'))
+        with client.makefile('r', encoding='utf-8') as events:
+            for line in events:
+                event = json.loads(line)
+                if event['event'] == 'accepted':
+                    print(f"Job accepted: {event['posts']} posts from {', '.join(event['exports'])}")
+                elif event['event'] == 'post':
+                    print(f"{event['export']}: {event['key']} -> {', '.join(event['outputs'].values()) or 'no outputs'}")
+                elif event['event'] == 'export_finished':
+                    print(f"Finished {event['export']}: {event['counters']}")
+                elif event['event'] in ['finished', 'error']:
+                    return event
+    return {'event': 'error', 'message': 'Daemon closed the connection'}
+
+# Watch-folder mode: new exports (folders or zip files) dropped into a folder are processed
+# as soon as they are complete. Sources that were processed are remembered in a state file
+# in the watched folder, together with the settings to use.
+WATCH_STATE_FILENAME = '.bereal-watch.json'
+WATCH_EXTRACT_FOLDER = '.extracted'
+
+def open_inotify(folder):
+    """Return an inotify file descriptor that wakes up on changes in folder, or None where inotify is not available"""
+    import ctypes
+    import ctypes.util
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    mask = 0x002 | 0x008 | 0x080 | 0x100 | 0x200
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(folder), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def wait_for_change(inotify_fd, timeout):
+    """Sleep for timeout seconds, or less if inotify reports a change"""
+    if inotify_fd is None:
+        time.sleep(timeout)
+        return
+    readable, _, _ = select.select([inotify_fd], [], [], timeout)
+    if readable:
+        try:
+            while os.read(inotify_fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+def get_source_signature(source):
+    """Return what a source looks like right now (posts.json and the sizes of its inputs, or a zip's size and mtime), or None"""
+    if source.suffix.lower() == '.zip':
+        stat = source.stat()
+        return ['zip', stat.st_size, stat.st_mtime_ns]
+    exports = find_exports([source]) if source.is_dir() else []
+    if not exports:
+        return None
+    signature = []
+    for export_path in exports:
+        json_stat = (export_path / 'posts.json').stat()
+        paths = get_export_paths(export_path)
+        # Only the extension is looked at, opening every file on each change would be slow
+        inputs = sorted([name, size] for folder in [paths['photo_folder'], paths['bereal_folder']]
+                        for name, size in index_folder(folder).items()
+                        if (folder / name).suffix.lower() in IMAGE_EXTENSIONS | VIDEO_EXTENSIONS)
+        signature.append([export_path.name, json_stat.st_size, json_stat.st_mtime_ns, inputs])
+    return signature
+
+def scan_watch_folder(watch_path):
+    with os.scandir(watch_path) as entries:
+        return sorted(Path(entry.path) for entry in entries
+                      if not entry.name.startswith('.') and (entry.is_dir() or entry.name.lower().endswith('.zip')))
+
+def get_new_entries(export_path, output_root):
+    """Return the posts.json entries that are not in the export's manifest yet, or None if it has no manifest"""
+    paths = get_export_paths(export_path, output_root)
+    manifest_path = paths['output_root'] / get_manifest_filename(None)
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, encoding='utf8') as f:
+        processed = {record['key'] for record in json.load(f)['posts']}
+    return [entry for entry in load_posts(paths['json_path']) if get_post_key(entry) not in processed]
+
+def prepare_watched_source(source, watch_path, settings, output_root=None, archive=None):
+    """Return the export states for the new work of a source that stopped changing"""
+    if source.suffix.lower() == '.zip':
+        extract_path = watch_path / WATCH_EXTRACT_FOLDER / source.stem
+        logging.info(f"Extracting {source.name} to {extract_path}")
+        with zipfile.ZipFile(source) as archive_file:
+            archive_file.extractall(extract_path)
+        source = extract_path
+    exports = find_exports([source])
+
+    states = []
+    for export_path, export_output_root in zip(exports, get_output_roots(exports, output_root)):
+        new_entries = get_new_entries(export_path, export_output_root)
+        if new_entries == []:
+            logging.info(f"Nothing new in {export_path}")
+            continue
+        if new_entries is not None:
+            logging.info(f"{len(new_entries)} new posts in {export_path}")
+        states.append(prepare_export(export_path, settings, export_output_root, data=new_entries, archive=archive))
+    return states
+
+def watch_folder(watch_path, settings, workers, output_root=None, archive=None, catalog=None, interval=2.0, settle=5.0,
+                 memory_budget=None):
+    """Process every export that appears in watch_path on one warm pool, once it stopped changing for settle seconds"""
+    watch_path = Path(watch_path)
+    state_path = watch_path / WATCH_STATE_FILENAME
+    try:
+        with open(state_path, encoding='utf8') as f:
+            watch_state = json.load(f)
+    except FileNotFoundError:
+        watch_state = {'settings': None, 'sources': {}}
+    if settings is not None:
+        watch_state['settings'] = settings
+    elif watch_state['settings'] is not None:
+        settings = validate_settings(watch_state['settings'])
+        logging.info(f"Using the settings stored in {state_path}")
+    else:
+        raise ValueError(f"No settings stored in {state_path} yet, pass them with --settings")
+    write_json_atomic(state_path, watch_state)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    # Without inotify the folder is scanned every interval seconds
+    inotify_fd = open_inotify(watch_path)
+    logging.info(f"Watching {watch_path} " + ("with inotify" if inotify_fd is not None else f"every {interval:g}s")
+                 + f", processing exports once they have not changed for {settle:g}s")
+    pending = {}  # Source -> (signature, time it was first seen with that signature)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            while True:
+                now = time.monotonic()
+                ready = []
+                for source in scan_watch_folder(watch_path):
+                    try:
+                        signature = get_source_signature(source)
+                    except OSError:
+                        signature = None  # Vanished or still being created
+                    if signature is None or watch_state['sources'].get(source.name) == signature:
+                        pending.pop(source, None)
+                    elif pending.get(source, (None,))[0] != signature:
+                        pending[source] = (signature, now)
+                    elif now - pending[source][1] >= settle:
+                        ready.append((source, pending.pop(source)[0]))
+
+                if ready:
+                    states = []
+                    for source, signature in ready:
+                        try:
+                            states += prepare_watched_source(source, watch_path, settings, output_root, archive)
+                        except Exception as e:
+                            logging.error(f"Could not prepare {source}: {e}")
+                        # Failed sources are tried again once they change
+                        watch_state['sources'][source.name] = signature
+                    for state in states:
+                        state['catalog_path'] = catalog
+                    if states:
+                        run_exports(states, settings, workers, pool, memory_budget=memory_budget)
+                    write_json_atomic(state_path, watch_state)
+                    continue
+
+                timeout = interval
+                if pending:
+                    oldest = min(first_seen for _, first_seen in pending.values())
+                    timeout = min(interval, max(0.1, settle - (now - oldest)))
+                wait_for_change(inotify_fd, timeout)
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        if inotify_fd is not None:
+            os.close(inotify_fd)
+        logging.info(f"Stopped watching {watch_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Process BeReal photos and videos.')
+    parser.add_argument('--path', type=str, help='Path to the BeReal data export folder')
+    parser.add_argument('--batch', type=str, nargs='+', metavar='PATH',
+                        help='Process several exports: export folders, or folders containing export folders')
+    parser.add_argument('--settings', type=str, help='JSON file with the settings to use instead of asking for them')
+    parser.add_argument('--output-root', type=str,
+                        help='Write the outputs of every export to OUTPUT_ROOT/<export folder name> instead of next to the photos')
+    parser.add_argument('--workers', type=int,
+                        help='Number of worker processes (default: 1 for --path, number of CPUs for --batch)')
+    parser.add_argument('--plan', '--dry-run', dest='plan', action='store_true',
+                        help='Only print the work plan (outputs, conversions, videos and estimated size), without processing anything')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help='Only process shard I (0 to N-1) of N, e.g. to split one export across several machines')
+    parser.add_argument('--merge-manifests', type=str, nargs='*', metavar='MANIFEST',
+                        help='Merge the shard manifests of a --shard run (default: the ones in the output folder of --path) into manifest.json')
+    parser.add_argument('--posts', type=str, metavar='FILE',
+                        help='Only process the entries in FILE (same format as posts.json) instead of all posts of the export')
+    parser.add_argument('--daemon', type=str, metavar='SOCKET',
+                        help='Run as a daemon with warm workers, taking jobs on the Unix socket SOCKET')
+    parser.add_argument('--submit', type=str, metavar='SOCKET',
+                        help='Send --path/--batch with --settings as a job to the daemon on SOCKET and print its progress')
+    parser.add_argument('--catalog', type=str,
+                        help='SQLite catalog to add the processed posts to (default: catalog.sqlite next to the output folders of each export)')
+    parser.add_argument('--dedupe', choices=['no', 'near'],
+                        help="'near' to detect posts whose front and back images look like those of an earlier post (overrides the settings)")
+    parser.add_argument('--dedupe-action', choices=['skip', 'link'],
+                        help='Skip near-duplicate posts, or link their outputs to the outputs of the earlier post (default: skip)')
+    parser.add_argument('--dedupe-distance', type=int, metavar='BITS',
+                        help='Maximum number of differing bits between perceptual hashes of near-duplicates (default: 6)')
+    parser.add_argument('--phash-index', type=str,
+                        help='Perceptual-hash index to use for --dedupe near (default: phash-index.json next to the output folders of each export)')
+    parser.add_argument('--archive', choices=['tar', 'zip'],
+                        help='Write the outputs into rolling tar or zip archives (uncompressed) with an index of member offsets, instead of one file each')
+    parser.add_argument('--archive-max-mb', type=int, default=ARCHIVE_DEFAULT_MAX_MB, metavar='MB',
+                        help=f'Start a new archive once the current one reaches this size (default: {ARCHIVE_DEFAULT_MAX_MB})')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check the outputs of an earlier run against posts.json and the manifest, and list the posts to redo')
+    parser.add_argument('--encoder-profile', choices=list(ENCODER_PROFILES),
+                        help='Encoder options for images and videos (default: default, how images were always encoded)')
+    parser.add_argument('--target-kb', type=int, metavar='KB',
+                        help='Lower the quality of every encoded full-size image until it is at most KB kilobytes')
+    parser.add_argument('--encoder-report', action='store_const', const='yes',
+                        help='Also encode every image with the default encoder, and report the bytes saved against the encode time')
+    parser.add_argument('--rendition', type=parse_rendition, action='append', metavar='NAME:MAX_SIZE[:FORMAT[:QUALITY]]',
+                        help='Also save every image downscaled to at most MAX_SIZE pixels into a NAME folder, '
+                             'e.g. web:2048:jpg:85 (repeat for several sizes; overrides the renditions in the settings)')
+    parser.add_argument('--watch', type=str, metavar='FOLDER',
+                        help='Keep watching FOLDER and process every export folder or zip file dropped into it once it is complete')
+    parser.add_argument('--watch-interval', type=float, default=2.0, metavar='SECONDS',
+                        help='How often --watch scans the folder where inotify is not available (default: 2)')
+    parser.add_argument('--settle', type=float, default=5.0, metavar='SECONDS',
+                        help='How long a new export has to stay unchanged before --watch processes it (default: 5)')
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+                        help='Only run as many posts at once as their estimated peak memory fits into MB megabytes '
+                             '(default workers: number of CPUs)')
+    parser.add_argument('--calibrate-video', type=str, nargs='?', const=str(VIDEO_CALIBRATION_PATH), metavar='FILE',
+                        help='Measure how fast this machine encodes BTS videos with several presets and thread counts, '
+                             f'and save it to FILE (default: {VIDEO_CALIBRATION_PATH})')
+    parser.add_argument('--video-calibration', type=str, default=str(VIDEO_CALIBRATION_PATH), metavar='FILE',
+                        help='Video calibration to use for --video-fps and --video-budget')
+    video_target = parser.add_mutually_exclusive_group()
+    video_target.add_argument('--video-fps', type=parse_video_target, metavar='FPS',
+                              help='Pick the calibrated video preset and parallel encodes with the smallest files that encode at least FPS frames per second')
+    video_target.add_argument('--video-budget', type=parse_video_target, metavar='SECONDS',
+                              help='Pick the calibrated video preset and parallel encodes with the smallest files that encode all BTS videos within SECONDS')
+    parser.add_argument('--timelapse', action='store_true',
+                        help=f'Only encode a timelapse of the combined images of all posts in the order they were taken, into {TIMELAPSE_FILENAME} next to the output folders')
+    parser.add_argument('--timelapse-size', type=parse_frame_size, default=TIMELAPSE_DEFAULT_SIZE, metavar='WIDTHxHEIGHT',
+                        help=f'Frame size of the timelapse (default: {TIMELAPSE_DEFAULT_SIZE[0]}x{TIMELAPSE_DEFAULT_SIZE[1]})')
+    parser.add_argument('--timelapse-fps', type=float, default=10, metavar='FPS',
+                        help='Frames (posts) per second of the timelapse (default: 10)')
+    parser.add_argument('--timelapse-dates', action='store_true',
+                        help='Show the date of every post in the timelapse')
+    parser.add_argument('--post-timeout', type=float, metavar='SECONDS',
+                        help='Stop a post that takes longer and quarantine its input (default: 600, 0 for no limit)')
+    parser.add_argument('--ffmpeg-timeout', type=float, metavar='SECONDS',
+                        help='Kill an ffmpeg or ffprobe call that takes longer and quarantine its input (default: 300, 0 for no limit)')
+    parser.add_argument('--max-megapixels', type=float, metavar='MP',
+                        help='Quarantine larger images instead of decoding them (default: 50)')
+    parser.add_argument('--text-overlay', choices=TEXT_OVERLAYS,
+                        help='Burn the date, the caption or both into the combined images and the timelapse (overrides the settings)')
+    parser.add_argument('--overlay-font', type=str, metavar='TTF',
+                        help="TrueType font for --text-overlay (default: Pillow's built-in font)")
+    args = parser.parse_args()
+    archive = {'format': args.archive, 'max_bytes': args.archive_max_mb * 1024 * 1024} if args.archive else None
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    setting_overrides = {key: value for key, value in [('dedupe', args.dedupe), ('dedupe_action', args.dedupe_action),
+                                                       ('dedupe_distance', args.dedupe_distance),
+                                                       ('renditions', args.rendition), ('encoder_profile', args.encoder_profile),
+                                                       ('target_kb', args.target_kb), ('encoder_report', args.encoder_report),
+                                                       ('post_timeout', args.post_timeout), ('ffmpeg_timeout', args.ffmpeg_timeout),
+                                                       ('max_megapixels', args.max_megapixels), ('text_overlay', args.text_overlay),
+                                                       ('overlay_font', args.overlay_font)] if value is not None}
+
+    if args.daemon:
+        serve_daemon(args.daemon, args.workers or os.cpu_count(), memory_budget)
+        return
+
+    if args.calibrate_video:
+        try:
+            calibrate_video(args.calibrate_video)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            logging.error(f"Video calibration failed: {e}")
+            exit(1)
+        return
+
+    if args.watch:
+        if setting_overrides and not args.settings:
+            parser.error("settings given on the command line need --settings with --watch")
+        try:
+            settings = validate_settings({**load_settings(args.settings), **setting_overrides}) if args.settings else None
+            watch_folder(args.watch, settings, args.workers or os.cpu_count(), args.output_root, archive, args.catalog,
+                         args.watch_interval, args.settle, memory_budget)
+        except (OSError, ValueError) as e:
+            logging.error(f"Cannot watch {args.watch}: {e}")
+            exit(1)
+        return
+
+    if not args.path and not args.batch:
+        parser.error("either --path or --batch is required")
+
+    start_time = time.perf_counter()
+    exports = find_exports(args.batch) if args.batch else [Path(args.path)]
+    output_roots = get_output_roots(exports, args.output_root)
+
+    try:
+        settings = load_settings(args.settings) if args.settings else None
+        # Check the settings given on the command line before asking for the others
+        validate_settings({**(settings or DEFAULT_SETTINGS), **setting_overrides})
+        posts = None
+        if args.posts:
+            if args.batch:
+                parser.error("--posts works with --path only")
+            posts = load_posts(args.posts)
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not load settings or posts: {e}")
+        exit(1)
+
+    if args.submit:
+        job = {
+            'exports': [str(Path(export_path).resolve()) for export_path in (args.batch or [args.path])],
+            'settings': {**(settings or DEFAULT_SETTINGS), **setting_overrides},
+            'output_root': str(Path(args.output_root).resolve()) if args.output_root else None,
+            'posts': posts,
+            'catalog': str(Path(args.catalog).resolve()) if args.catalog else None,
+            'phash_index': str(Path(args.phash_index).resolve()) if args.phash_index else None,
+            'archive': archive,
+        }
+        try:
+            event = submit_job(args.submit, job)
+        except OSError as e:
+            logging.error(f"Could not reach the daemon on {args.submit}: {e}")
+            exit(1)
+        if event['event'] == 'error':
+            logging.error(f"Job failed: {event['message']}")
+            exit(1)
+        counters = event['counters']
+        logging.info(f"Finished processing in {time.perf_counter() - start_time:.1f}s.\n{format_counters(counters)}")
+        return
+
+    if args.merge_manifests is not None:
+        if args.batch:
+            parser.error("--merge-manifests works with --path only")
+        paths = get_export_paths(exports[0], output_roots[0])
+        manifest_paths = args.merge_manifests or sorted(paths['output_root'].glob('manifest-shard-*-of-*.json'))
+        try:
+            merged = merge_manifests(manifest_paths)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not merge manifests: {e}")
+            exit(1)
+        manifest_path = paths['output_root'] / get_manifest_filename(None)
+        write_json_atomic(manifest_path, merged)
+        update_catalog(merged, paths['output_root'], args.catalog)
+        counters = merged['counters']
+        logging.info(f"Finished processing: merged {merged['merged_shards']} shard manifests into {manifest_path}.\nPosts: {len(merged['posts'])}\n{format_counters(counters)}")
+        return
+
+    if args.verify:
+        failed = False
+        for export_path, output_root in zip(exports, output_roots):
+            paths = get_export_paths(export_path, output_root)
+            try:
+                result = verify_export(paths, args.workers or os.cpu_count())
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not verify {export_path}: {e}")
+                failed = True
+                continue
+            for key, role, problem in result['problems']:
+                logging.error(f"{key}" + (f" [{role}]" if role else "") + f": {problem}")
+            redo_path = paths['output_root'] / 'redo-posts.json'
+            if result['redo']:
+                write_json_atomic(redo_path, result['redo'])
+                logging.error(f"{len(result['redo'])} posts need to be processed again. To redo them, run with --path {export_path} --posts {redo_path}")
+            else:
+                redo_path.unlink(missing_ok=True)
+            failed = failed or bool(result['problems'])
+            logging.info(f"Finished processing: verified {Path(export_path).name} in {time.perf_counter() - start_time:.1f}s.\n"
+                         f"Files checked: {result['files']}\nProblems: {len(result['problems'])}\nPosts to redo: {len(result['redo'])}")
+        exit(1 if failed else 0)
+
+    if args.timelapse:
+        if not ffmpeg_available():
+            exit(1)
+        timelapse_settings = validate_settings({**(settings or DEFAULT_SETTINGS), **setting_overrides})
+        failed = False
+        for export_path, output_root in zip(exports, output_roots):
+            paths = get_export_paths(export_path, output_root)
+            paths['output_root'].mkdir(parents=True, exist_ok=True)
+            output_path = paths['output_root'] / TIMELAPSE_FILENAME
+            try:
+                frames = make_timelapse(paths, timelapse_settings, output_path, args.timelapse_size, args.timelapse_fps,
+                                        args.timelapse_dates, args.workers or os.cpu_count())
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not make the timelapse of {export_path}: {e}")
+                failed = True
+                continue
+            logging.info(f"Timelapse saved: {output_path} ({frames} frames, {frames / args.timelapse_fps:.1f}s, "
+                         f"{format_bytes(output_path.stat().st_size)}) in {time.perf_counter() - start_time:.1f}s")
+        exit(1 if failed else 0)
+
+    if args.plan:
+        for export_path, output_root in zip(exports, output_roots):
+            paths = get_export_paths(export_path, output_root)
+            try:
+                data = posts if posts is not None else load_posts(paths['json_path'])
+            except FileNotFoundError:
+                logging.error(f"JSON file not found in {export_path}. Please check the path.")
+                continue
+            print(STYLING["BOLD"] + f"\nExport: {export_path}" + STYLING["RESET"])
+            plan = plan_export(paths, data, validate_settings({**(settings or DEFAULT_SETTINGS), **setting_overrides}), index_export(paths), args.shard)
+            print_plan(plan)
+        print(f"Plan computed in {time.perf_counter() - start_time:.2f}s")
+        return
+
+    if args.batch:
+        print(STYLING["BOLD"] + f"\nFound {len(exports)} exports:" + STYLING["RESET"])
+        for export_path, output_root in zip(exports, output_roots):
+            print(f"{export_path}" + (f" -> {output_root}" if output_root else ""))
+    else:
+        paths = get_export_paths(exports[0], output_roots[0])
+        photo_folder = paths['photo_folder']
+        bereal_folder = paths['bereal_folder']
+
+        # Print the paths
+        print(STYLING["BOLD"] + "\nThe following paths are set for the input and output files:" + STYLING["RESET"])
+        print(f"Photo folder: {photo_folder}")
+        if os.path.exists(bereal_folder):
+            print(f"Older photo folder: {bereal_folder}")
+        print(f"Output folder for singular images: {paths['output_folder']}")
+        print(f"Output folder for combined images: {paths['output_folder_combined']}")
+        if archive:
+            print(f"Outputs are written to {archive['format']} archives in: {paths['output_root']}")
+        print("")
+
+        number_of_files = count_files_in_folder(photo_folder)
+        print(f"Number of image files in {photo_folder}: {number_of_files}")
+
+        if os.path.exists(bereal_folder):
+            number_of_files = count_files_in_folder(bereal_folder)
+            print(f"Number of (older) image files in {bereal_folder}: {number_of_files}")
+
+    if settings is None:
+        settings = prompt_settings()
+    settings = validate_settings({**settings, **setting_overrides})
+
+    # Load the JSON files
+    states = []
+    for export_path, output_root in zip(exports, output_roots):
+        try:
+            states.append(prepare_export(export_path, settings, output_root, args.shard, posts, archive))
+        except FileNotFoundError:
+            logging.error(f"JSON file not found in {export_path}. Please check the path.")
+        except ValueError as e:
+            logging.error(f"Cannot process {export_path}: {e}")
+            exit(1)
+    if not states:
+        exit()
+    for state in states:
+        state['catalog_path'] = args.catalog
+        if args.phash_index:
+            state['paths']['phash_index'] = Path(args.phash_index).resolve()
+
+    # With a memory budget or a video target, they limit how many posts or videos run at once,
+    # the workers are only the upper bound
+    video_target = args.video_fps or args.video_budget
+    workers = args.workers or (os.cpu_count() if args.batch or memory_budget or video_target else 1)
+    video_jobs = None
+    if video_target and settings['create_combined_images'] == 'yes':
+        try:
+            video_jobs = apply_video_calibration(states, settings, workers, args)
+        except ValueError as e:
+            logging.error(str(e))
+            exit(1)
+    run_exports(states, settings, workers, memory_budget=memory_budget, video_jobs=video_jobs)
+
+    if len(states) > 1:
+        total = new_counters()
+        for state in states:
+            add_counters(total, state['counters'])
+        logging.info(f"Finished processing all {len(states)} exports in {time.perf_counter() - start_time:.1f}s.\n{format_counters(total)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import functools
+import math
+
+
+CAPTION_MAX_LINES = 3
+BAND_OPACITY = 110  # Of the dark band behind the text, 0-255
+FONT_SIZE_RATIO = 1 / 28  # Font size relative to the image width
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(font_path, size):
+    """Load a TrueType font once per process; None gives Pillow's built-in font"""
+    from PIL import ImageFont
+
+    if font_path:
+        return ImageFont.truetype(font_path, size)
+    return ImageFont.load_default(size)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_glyph(font_path, size, char):
+    """Return (mask or None, (left, top) offset, advance) of one character, rendered once"""
+    from PIL import Image, ImageDraw
+
+    font = get_font(font_path, size)
+    advance = font.getlength(char)
+    left, top, right, bottom = font.getbbox(char)
+    if right <= left or bottom <= top:  # Spaces and other blank characters
+        return None, (0, 0), advance
+    mask = Image.new('L', (right - left, bottom - top))
+    ImageDraw.Draw(mask).text((-left, -top), char, font=font, fill=255)
+    return mask, (left, top), advance
+
+
+def get_text_width(text, font_path, size):
+    return sum(get_glyph(font_path, size, char)[2] for char in text)
+
+
+@functools.lru_cache(maxsize=1024)
+def render_line(text, font_path, size):
+    """Return the mask of one line of text, put together from the cached glyphs (without kerning)"""
+    from PIL import Image
+
+    font = get_font(font_path, size)
+    ascent, descent = font.getmetrics()
+    line = Image.new('L', (max(1, math.ceil(get_text_width(text, font_path, size))), ascent + descent))
+    x = 0
+    for char in text:
+        mask, (left, top), advance = get_glyph(font_path, size, char)
+        if mask is not None:
+            line.paste(255, (round(x) + left, top), mask)
+        x += advance
+    return line
+
+
+def wrap_text(text, font_path, size, max_width, max_lines):
+    """Break text into lines of at most max_width pixels, shortening the last line with '…' if there are too many"""
+    lines = []
+    for paragraph in text.splitlines() or ['']:
+        line = ''
+        for word in paragraph.split():
+            candidate = f"{line} {word}" if line else word
+            if line and get_text_width(candidate, font_path, size) > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    lines = [line for line in lines if line]
+    if len(lines) > max_lines:
+        lines = lines[:max_lines - 1] + [_shorten(lines[max_lines - 1], font_path, size, max_width)]
+    # A single word wider than the image is cut as well
+    return [line if get_text_width(line, font_path, size) <= max_width else _shorten(line, font_path, size, max_width)
+            for line in lines]
+
+
+def _shorten(text, font_path, size, max_width):
+    while text and get_text_width(text + '…', font_path, size) > max_width:
+        text = text[:-1]
+    return text.rstrip() + '…'
+
+
+def draw_text_band(image, texts, font_path=None):
+    """Burn texts (e.g. a caption and a date) into a dark band at the bottom of an RGB image, in place"""
+    from PIL import Image
+
+    size = max(12, round(image.width * FONT_SIZE_RATIO))
+    padding = size // 2
+    lines = []
+    for text, max_lines in texts:
+        lines += wrap_text(text, font_path, size, image.width - 2 * padding, max_lines)
+    if not lines:
+        return image
+
+    masks = [render_line(line, font_path, size) for line in lines]
+    band_height = sum(mask.height for mask in masks) + 2 * padding
+    top = max(0, image.height - band_height)
+    # Only the band is touched, darkened through a constant mask
+    image.paste((0, 0, 0), (0, top, image.width, image.height), Image.new('L', (image.width, image.height - top), BAND_OPACITY))
+    y = top + padding
+    for mask in masks:
+        image.paste((255, 255, 255), ((image.width - mask.width) // 2, y), mask)
+        y += mask.height
+    return image
@@ -0,0 +1,168 @@
+import hashlib
+import mmap
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+EXIF_HEADER = b'Exif\x00\x00'
+
+
+def check_jpeg(data):
+    """Return (problem or None, EXIF bytes or None) for the bytes of a JPEG file"""
+    # Walks the marker segments up to the start of scan, then requires the end-of-image marker
+    if data[:2] != JPEG_SOI:
+        return "not a JPEG file", None
+    exif = None
+    position = 2
+    while True:
+        if position + 4 > len(data) or data[position] != 0xFF:
+            return "broken JPEG segment structure", exif
+        marker = data[position + 1]
+        if marker == 0xFF:  # Fill byte
+            position += 1
+            continue
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        if position + 2 + length > len(data):
+            return "truncated JPEG header", exif
+        if marker == 0xE1 and data[position + 4:position + 10] == EXIF_HEADER and exif is None:
+            exif = bytes(data[position + 4:position + 2 + length])
+        position += 2 + length
+        if marker == 0xDA:  # Start of scan, the entropy-coded data follows
+            break
+    if data[-2:] != JPEG_EOI:
+        return "truncated JPEG data (no end-of-image marker)", exif
+    return None, exif
+
+
+def check_webp(data):
+    """Return (problem or None, EXIF bytes or None) for the bytes of a WebP file"""
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        return "not a WebP file", None
+    riff_size = struct.unpack('<I', data[4:8])[0]
+    if riff_size + 8 > len(data):
+        return "truncated WebP file", None
+    exif = None
+    position = 12
+    end = riff_size + 8
+    while position < end:
+        if position + 8 > end:
+            return "broken WebP chunk structure", exif
+        fourcc = bytes(data[position:position + 4])
+        size = struct.unpack('<I', data[position + 4:position + 8])[0]
+        if position + 8 + size > end:
+            return f"truncated WebP chunk {fourcc.decode('latin-1')}", exif
+        if fourcc == b'EXIF':
+            exif = bytes(data[position + 8:position + 8 + size])
+            if not exif.startswith(EXIF_HEADER):
+                exif = EXIF_HEADER + exif
+        position += 8 + size + (size & 1)
+    return None, exif
+
+
+def check_mp4(data):
+    """Return a problem or None for the bytes of an MP4/MOV file"""
+    # The top-level boxes have to add up to the file size exactly, which catches files a killed ffmpeg left behind
+    boxes = set()
+    position = 0
+    while position < len(data):
+        if position + 8 > len(data):
+            return "truncated MP4 box header"
+        size, box_type = struct.unpack('>I4s', data[position:position + 8])
+        if size == 1:
+            if position + 16 > len(data):
+                return "truncated MP4 box header"
+            size = struct.unpack('>Q', data[position + 8:position + 16])[0]
+        elif size == 0:
+            size = len(data) - position
+        if size < 8 or position + size > len(data):
+            return f"truncated MP4 box {box_type.decode('latin-1')}"
+        boxes.add(box_type)
+        position += size
+    for required in [b'ftyp', b'moov', b'mdat']:
+        if required not in boxes:
+            return f"MP4 file without {required.decode()} box"
+    return None
+
+
+def read_datetime_original(exif):
+    """Return EXIF DateTimeOriginal as 'YYYY:MM:DD HH:MM:SS', or None"""
+    import piexif
+
+    try:
+        value = piexif.load(exif)['Exif'].get(piexif.ExifIFD.DateTimeOriginal)
+    except Exception:
+        return None
+    return value.decode('ascii', 'replace') if value else None
+
+
+def verify_file(path, offset=0, size=None, expected_bytes=None, expected_datetime=None):
+    """Check one output file, or one member of an archive, and return its problems and SHA-256"""
+    # Memory-mapped, so the checks only touch the pages they need and hashing copies nothing
+    result = {'problems': [], 'sha256': None}
+    try:
+        with open(path, 'rb') as f:
+            file_size = f.seek(0, 2)
+            if size is None:
+                size = file_size - offset
+            if offset + size > file_size:
+                result['problems'].append("archive member is truncated")
+                return result
+            if size == 0:
+                result['problems'].append("file is empty")
+                return result
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                data = memoryview(mapped)[offset:offset + size]
+                try:
+                    _check_contents(data, result, expected_bytes, expected_datetime)
+                    result['sha256'] = hashlib.sha256(data).hexdigest()
+                finally:
+                    data.release()
+    except FileNotFoundError:
+        result['problems'].append("file is missing")
+    except OSError as e:
+        result['problems'].append(f"cannot be read: {e}")
+    return result
+
+
+def _check_contents(data, result, expected_bytes, expected_datetime):
+    if expected_bytes is not None and len(data) != expected_bytes:
+        result['problems'].append(f"size is {len(data)} bytes, the run wrote {expected_bytes}")
+
+    kind = _get_kind(data)
+    exif = None
+    if kind == 'jpeg':
+        problem, exif = check_jpeg(data)
+    elif kind == 'webp':
+        problem, exif = check_webp(data)
+    elif kind == 'mp4':
+        problem = check_mp4(data)
+    else:
+        problem = "unknown file format"
+    if problem:
+        result['problems'].append(problem)
+
+    if expected_datetime and kind in ['jpeg', 'webp']:
+        found = read_datetime_original(exif) if exif else None
+        if found is None:
+            result['problems'].append("no EXIF DateTimeOriginal")
+        elif found != expected_datetime:
+            result['problems'].append(f"EXIF DateTimeOriginal is {found}, expected {expected_datetime}")
+
+
+def _get_kind(data):
+    if data[:2] == JPEG_SOI:
+        return 'jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[4:8] == b'ftyp':
+        return 'mp4'
+    return None
+
+
+def verify_files(checks, workers):
+    """Run verify_file for a list of keyword-argument dicts on a thread pool, results in the same order"""
+    # Hashing and the page faults of memory-mapped reads release the GIL
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda check: verify_file(**check), checks))